@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""bench_startup -- Time a cold start of duo.
+
+Each run is a fresh interpreter that imports duo and declares a
+hundred Table and Item classes, which is roughly what a CLI tool or a
+serverless handler does before it gets to work.
+
+Importing duo shouldn't import boto, so it has to cost less than
+importing boto's DynamoDB modules on their own, which is what it used
+to cost on top.
+
+    python bench_startup.py [runs]
+"""
+import os
+import sys
+import subprocess
+import py_compile
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+SCRIPT = """
+import sys, time
+start = time.time()
+import duo
+imported = time.time()
+boto_imported = 'boto' in sys.modules
+for i in range(%(classes)d):
+    table = type('Table%%d' %% i, (duo.Table, ), dict(
+        table_name='table_%%d' %% i, hash_key_name='id', range_key_name='sort'))
+    type('Item%%d' %% i, (table, duo.Item), dict(cache_duration=60))
+declared = time.time()
+sys.stdout.write('%%f %%f %%d\\n' %% (imported - start, declared - imported, boto_imported))
+"""
+
+BOTO_SCRIPT = """
+import sys, time
+start = time.time()
+import boto.dynamodb2.items, boto.dynamodb2.table
+sys.stdout.write('%f\\n' % (time.time() - start))
+"""
+
+
+def run(classes=100):
+    """Time one cold start: (import seconds, declaration seconds, whether importing duo imported boto).
+    """
+    # Time duo the way it's installed, not Python compiling its source.
+    py_compile.compile(os.path.join(HERE, 'duo.py'))
+    output = subprocess.check_output([sys.executable, '-c', SCRIPT % dict(classes=classes)], cwd=HERE)
+    import_time, declare_time, boto_imported = output.split()
+    return float(import_time), float(declare_time), bool(int(boto_imported))
+
+
+def run_boto():
+    """Time importing boto's DynamoDB modules in a fresh interpreter, in seconds.
+
+    This is the budget for importing duo.
+    """
+    return float(subprocess.check_output([sys.executable, '-c', BOTO_SCRIPT]))
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def main(runs=10):
+    results = [run() for _ in range(runs)]
+    import_time = median([r[0] for r in results])
+    budget = median([run_boto() for _ in range(runs)])
+    sys.stdout.write('import duo:          %.1f ms (median of %d)\n' % (import_time * 1000, runs))
+    sys.stdout.write('declare 100 classes: %.1f ms (median of %d)\n' % (median([r[1] for r in results]) * 1000, runs))
+    sys.stdout.write('import boto:         %.1f ms (median of %d)\n' % (budget * 1000, runs))
+    if any(r[2] for r in results):
+        sys.stdout.write('importing duo imported boto\n')
+        return 1
+    if import_time >= budget:
+        sys.stdout.write('importing duo took longer than importing boto\n')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*[int(arg) for arg in sys.argv[1:]]))
@@ -36,11 +36,88 @@ import datetime
 import time
 import json
 import hashlib
+import weakref
+import copy
+import marshal
+import struct
+import zlib
+import base64
+import math
+import cPickle as pickle
+import threading
+import atexit
+import contextlib
+import functools
+import itertools
+import random
+import bisect
+import Queue
+import os
+import sys
+import importlib
+from decimal import Decimal
+
+# Comparison operators DynamoDB accepts in a query's key conditions.
+_KEY_OPERATORS = ('eq', 'lte', 'lt', 'gte', 'gt', 'beginswith', 'between')
+
+# boto takes a while to import, and plenty of programs import duo
+# without ever talking to DynamoDB, so duo doesn't import boto until
+# it's actually needed: the first time an Item class is declared or a
+# table is looked up, in practice.
+
+
+class _Boto(object):
+    """The parts of boto duo uses, imported on first access.
+
+    Loading also builds the real `duo.Item`, on top of boto's Item.
+    """
+    _lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        self.load()
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def load(self):
+        with self._lock:
+            if 'Item' in self.__dict__:
+                return
+
+            from boto.dynamodb2.items       import Item as BotoItem
+            from boto.dynamodb2.exceptions  import ItemNotFound
+            from boto.dynamodb2.table       import Table
+            from boto.dynamodb.types        import Binary, Dynamizer
+
+            item = _TableMeta('Item', (_ItemMixin, BotoItem), dict(
+                __module__=__name__, __doc__=_ItemMixin.__doc__))
+            globals()['Item'] = item
+            self.__dict__.update(
+                ItemNotFound = ItemNotFound,
+                Table = Table,
+                Binary = Binary,
+                Dynamizer = Dynamizer,
+                Item = item,
+                )
+
+_boto = _Boto()
+
+
+class _ItemNotFoundMeta(type):
+    def __subclasscheck__(cls, subclass):
+        return type.__subclasscheck__(cls, subclass) or issubclass(subclass, _boto.ItemNotFound)
 
-import boto
-from boto.dynamodb2.items       import Item as _Item
-from boto.dynamodb2.exceptions  import ItemNotFound
-from boto.dynamodb2.table       import Table as _Table
+    def __instancecheck__(cls, instance):
+        return cls.__subclasscheck__(type(instance))
+
+
+class ItemNotFound(Exception):
+    """Matches boto's `ItemNotFound`, which is what duo raises, without importing boto.
+    """
+    __metaclass__ = _ItemNotFoundMeta
 
 # First off, since we have integers as one of our two native data
 # types, we're going to do enumerated types, which are great. You're
@@ -175,18 +252,120 @@ class DynamoDB(object):
 
          # Assuming you've already declared a table named `my_table_name`:
          my_table = DYNAMODB['my_table_name']
+
+    Unless `track_capacity=False`, duo asks DynamoDB how much capacity
+    each request consumed, and keeps count; see `capacity_report()`.
+
+    Set `recorder` to a `TraceRecorder` to log the reads and writes
+    made through this connection, for `replay()` to play back later.
     """
-    def __init__(self, key, secret, cache=None):
+    recorder = None
+
+    def __init__(self, key, secret, cache=None, track_capacity=True):
         self.key = key
         self.secret = secret
         self._tables = {}
         self.cache = cache
+        self.stats = collections.Counter()
+        self._write_behind = {}
+        self._write_behind_lock = threading.Lock()
+        self.track_capacity = track_capacity
+        # Capacity units consumed, by (table, index, operation, tag).
+        self._capacity = collections.defaultdict(float)
+        self._capacity_lock = threading.Lock()
+        self._capacity_tags = threading.local()
+
+    def cache_hit_rate(self):
+        """Return the share of cached lookups that were served from the cache.
+        """
+        lookups = self.stats['cache_hits'] + self.stats['cache_misses']
+        return float(self.stats['cache_hits']) / lookups if lookups else 0.0
+
+    @contextlib.contextmanager
+    def capacity_tag(self, tag):
+        """Count capacity consumed in this block, in this thread, under `tag`.
+
+        Example::
+
+            with DYNAMODB.capacity_tag('checkout'):
+                cart = carts[user_id]
+        """
+        previous = getattr(self._capacity_tags, 'tag', None)
+        self._capacity_tags.tag = tag
+        try:
+            yield
+        finally:
+            self._capacity_tags.tag = previous
+
+    def _carry_capacity_tag(self, function):
+        """Wrap `function` to count capacity under this thread's current tag, in whichever thread calls it.
+
+        For work handed off to duo's own threads.
+        """
+        tag = getattr(self._capacity_tags, 'tag', None)
+
+        @functools.wraps(function)
+        def tagged(*args, **kwargs):
+            with self.capacity_tag(tag):
+                return function(*args, **kwargs)
+        return tagged
+
+    def _record_capacity(self, operation, consumed):
+        """Add up the `ConsumedCapacity` from a DynamoDB response.
+        """
+        if consumed is None:
+            return
+        if isinstance(consumed, dict):
+            consumed = [consumed]
+
+        tag = getattr(self._capacity_tags, 'tag', None)
+        with self._capacity_lock:
+            if operation in _CapacityConnection.read_operations:
+                self.stats['read_requests'] += 1
+            for capacity in consumed:
+                table_name = capacity.get('TableName')
+                units = capacity.get('Table', capacity).get('CapacityUnits', 0)
+                self._capacity[table_name, None, operation, tag] += units
+                for indexes in ('LocalSecondaryIndexes', 'GlobalSecondaryIndexes'):
+                    for index_name, index in capacity.get(indexes, {}).iteritems():
+                        self._capacity[table_name, index_name, operation, tag] += index['CapacityUnits']
+
+    def capacity_report(self, top=10):
+        """Summarize the capacity consumed so far.
+
+        Returns a dict with `read_units` and `write_units` totals; `by_table`,
+        `by_class` (Item subclass), `by_index`, `by_operation` and `by_tag`
+        breakdowns (each a dict of `{'read': units, 'write': units}`);
+        `top`, the `top` biggest `((table, index, operation, tag), units)`
+        consumers; and `cache_share`, the share of reads served from the cache.
+        """
+        with self._capacity_lock:
+            capacity = dict(self._capacity)
+
+        report = dict(read_units=0.0, write_units=0.0)
+        breakdowns = dict((name, collections.defaultdict(lambda: dict(read=0.0, write=0.0)))
+                          for name in ('by_table', 'by_class', 'by_index', 'by_operation', 'by_tag'))
+        for (table_name, index_name, operation, tag), units in capacity.iteritems():
+            kind = 'read' if operation in _CapacityConnection.read_operations else 'write'
+            report['%s_units' % kind] += units
+            breakdowns['by_table'][table_name][kind] += units
+            breakdowns['by_class'][Item._table_types[table_name].__name__][kind] += units
+            breakdowns['by_index'][table_name, index_name][kind] += units
+            breakdowns['by_operation'][operation][kind] += units
+            breakdowns['by_tag'][tag][kind] += units
+        report.update((name, dict(breakdown)) for name, breakdown in breakdowns.iteritems())
+
+        report['top'] = sorted(capacity.iteritems(), key=lambda pair: -pair[1])[:top]
+        reads = self.stats['cache_hits'] + self.stats['read_requests']
+        report['cache_share'] = float(self.stats['cache_hits']) / reads if reads else 0.0
+        return report
 
     @property
     def connection(self):
         """Lazy-load a boto DynamoDB connection.
         """
         if not hasattr(self, '_connection'):
+            import boto
             self._connection = boto.connect_dynamodb(
                 aws_access_key_id=self.key,
                 aws_secret_access_key=self.secret
@@ -195,11 +374,34 @@ class DynamoDB(object):
 
     def reset(self):
         """Reset the DynamoDB connection and clear any cached tables.
+
+        Any buffered write-behind puts are flushed first.
         """
+        self.flush()
         if hasattr(self, '_connection'):
             del self._connection
         self._tables.clear()
 
+    def flush(self):
+        """Write out all buffered write-behind puts now.
+        """
+        for queue in self._write_behind.values():
+            queue.flush()
+
+    def _get_write_behind_queue(self, item):
+        """Return the write-behind queue for the given item's table, starting it if need be.
+        """
+        table_name = item.duo_table.table_name
+        with self._write_behind_lock:
+            if table_name not in self._write_behind:
+                self._write_behind[table_name] = _WriteBehindQueue(
+                    item.table,
+                    interval = item.write_behind_interval,
+                    batch_size = item.write_behind_batch_size,
+                    max_size = item.write_behind_max_queue,
+                    )
+            return self._write_behind[table_name]
+
     def __getitem__(self, key):
         """Retrieve a registered custom table by name.
         """
@@ -213,7 +415,10 @@ class DynamoDB(object):
             table_name = table_name.table_name
 
         if table_name not in self._tables:
-            self._tables[table_name] = _Table(table_name)
+            self._tables[table_name] = _boto.Table(table_name)
+            if self.track_capacity:
+                self._tables[table_name].connection = _CapacityConnection(
+                    self._tables[table_name].connection, self)
 
         if table_model:
             table = table_model(self, self._tables[table_name], cache=self.cache)
@@ -224,6 +429,235 @@ class DynamoDB(object):
         return table
 
 
+class _CapacityConnection(object):
+    """Wraps a boto DynamoDB connection to ask for, and count, consumed capacity.
+    """
+    operations = {
+        'get_item': 'get_item',
+        'batch_get_item': 'batch_get',
+        'query': 'query',
+        'scan': 'scan',
+        'put_item': 'put',
+        'update_item': 'put',
+        'delete_item': 'delete',
+        'batch_write_item': 'batch_write',
+        }
+    read_operations = frozenset(['get_item', 'batch_get', 'query', 'scan'])
+
+    def __init__(self, connection, db):
+        self.connection = connection
+        self.db = db
+
+    def __getattr__(self, name):
+        method = getattr(self.connection, name)
+        if name not in self.operations:
+            return method
+
+        def call(*args, **kwargs):
+            kwargs.setdefault('return_consumed_capacity', 'INDEXES')
+            response = method(*args, **kwargs)
+            self.db._record_capacity(self.operations[name], response.get('ConsumedCapacity'))
+            return response
+        return call
+
+
+# To tune cache durations or capacity against realistic load, duo can
+# record what an application asks of its tables: which operation, on
+# which key, when, and how long it took. Keys are hashed, and results
+# aren't kept, so a trace can leave production safely.
+
+
+def _item_size(data):
+    """Roughly how many bytes DynamoDB counts for an item with the given attributes.
+    """
+    return sum(len(name) + len(unicode(value)) for name, value in data.iteritems())
+
+
+class TraceRecorder(object):
+    """Writes a trace of table operations to `file`, one JSON object per line.
+
+    Records `Table[key]`, `.get_item()`, `.query()` and `.scan()`, and
+    `Item.put()` and `.delete()`: the operation, table, time since
+    recording started (`t`), duration in milliseconds (`ms`), and the
+    key or query conditions, with every key and value replaced by a
+    salted hash. Reads note whether they found anything, and reads and
+    puts the item's approximate size. Only `sample` of all operations
+    are recorded.
+
+    Example::
+
+        DYNAMODB.recorder = duo.TraceRecorder(open('trace.jsonl', 'a'), sample=0.1)
+    """
+    def __init__(self, file, salt=None, sample=1.0):
+        self.file = file
+        self.salt = salt if salt is not None else os.urandom(8).encode('hex')
+        self.sample = sample
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _hash(self, value):
+        if isinstance(value, (list, tuple, set, frozenset)):
+            return [self._hash(part) for part in value]
+        return hashlib.sha1(self.salt + KeyFilter._encode((value, ))).hexdigest()[:16]
+
+    def _describe(self, operation, obj, args, kwargs, result):
+        if isinstance(obj, Item):
+            table = obj.duo_table
+            hash_key = obj[table.hash_key_name]
+            range_key = obj.get(table.range_key_name) if table.range_key_name else None
+            entry = dict(table=table.table_name)
+            if operation == 'put':
+                entry['size'] = _item_size(obj._data)
+        else:
+            table = obj
+            entry = dict(table=table.table_name)
+            if operation == 'get':
+                key = args[0] if args else kwargs['key']
+                hash_key, range_key = key if isinstance(key, tuple) else (key, None)
+            elif operation == 'get_item':
+                hash_key = args[0] if args else kwargs['hash_key']
+                range_key = args[1] if len(args) > 1 else kwargs.get('range_key')
+            else:
+                hash_key = None
+                entry['conditions'] = dict((name, self._hash(value)) for name, value in kwargs.iteritems()
+                                           if name.rpartition('__')[0])
+                entry['limit'] = args[0] if args and operation == 'query' else kwargs.get('limit')
+                if operation == 'query':
+                    entry['index'] = kwargs.get('index')
+                    entry['reverse'] = kwargs.get('reverse', False)
+
+        if hash_key is not None:
+            entry['key'] = [self._hash(hash_key)]
+            if range_key is not None:
+                entry['key'].append(self._hash(range_key))
+        if isinstance(result, Item):
+            entry['found'] = not result.is_new
+            if entry['found']:
+                entry['size'] = _item_size(result._data)
+        return entry
+
+    def record(self, operation, obj, args, kwargs, result, error, started):
+        """Write one operation to the trace.
+        """
+        if self.sample < 1 and random.random() >= self.sample:
+            return
+        try:
+            entry = self._describe(operation, obj, args, kwargs, result)
+            entry.update(op=operation, t=round(started - self.started, 6),
+                         ms=round((time.time() - started) * 1000, 3))
+            if isinstance(error, ItemNotFound):
+                entry['found'] = False
+            elif error is not None:
+                entry['error'] = error.__class__.__name__
+            line = json.dumps(entry, sort_keys=True)
+            with self._lock:
+                self.file.write(line + '\n')
+        except Exception as e:
+            warnings.warn('Trace recording failed. %s: %s' % (e.__class__.__name__, e))
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+
+
+def _traced(operation):
+    """Decorate a Table or Item method to be recorded by the DB's `TraceRecorder`, if it has one.
+
+    Only the outermost traced call is recorded, so that `Table[key]`
+    isn't recorded again as the `get_item()` it makes.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def traced(self, *args, **kwargs):
+            recorder = getattr(self.duo_db, 'recorder', None)
+            if recorder is None or getattr(recorder._local, 'busy', False):
+                return method(self, *args, **kwargs)
+
+            recorder._local.busy = True
+            started = time.time()
+            result = error = None
+            try:
+                result = method(self, *args, **kwargs)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                recorder._local.busy = False
+                if error is not None or not hasattr(result, 'next'):
+                    recorder.record(operation, self, args, kwargs, result, error, started)
+            if hasattr(result, 'next'):
+                # Lazy results make their requests as they're read.
+                return _traced_results(recorder, operation, self, args, kwargs, result, started)
+            return result
+        return traced
+    return decorator
+
+
+def _traced_results(recorder, operation, obj, args, kwargs, results, started):
+    """Yield from lazy query or scan `results`, recording the operation once they're read (or dropped).
+    """
+    error = None
+    try:
+        for result in results:
+            yield result
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        recorder.record(operation, obj, args, kwargs, None, error, started)
+
+
+class _RawItemConnection(object):
+    """Wraps a boto DynamoDB connection to set aside the items it fetches, undecoded.
+
+    While `capture()` is on in a thread, the items in query, scan and
+    batch get responses are collected, still encoded, into the list it
+    yields, and boto is given none to decode.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    @contextlib.contextmanager
+    def capture(self):
+        self.local.raw_items = raw_items = []
+        try:
+            yield raw_items
+        finally:
+            self.local.raw_items = None
+
+    def _set_aside(self, items):
+        raw_items = getattr(self.local, 'raw_items', None)
+        if raw_items is None:
+            return items
+        raw_items.extend(items)
+        return []
+
+    def query(self, *args, **kwargs):
+        response = self.connection.query(*args, **kwargs)
+        if 'Items' in response:
+            response = dict(response, Items=self._set_aside(response['Items']))
+        return response
+
+    def scan(self, *args, **kwargs):
+        response = self.connection.scan(*args, **kwargs)
+        if 'Items' in response:
+            response = dict(response, Items=self._set_aside(response['Items']))
+        return response
+
+    def batch_get_item(self, *args, **kwargs):
+        response = self.connection.batch_get_item(*args, **kwargs)
+        responses = dict((table_name, self._set_aside(items))
+                         for table_name, items in response.get('Responses', {}).iteritems())
+        return dict(response, Responses=responses)
+
+_raw_item_connections_lock = threading.Lock()
+
+
 # Another metaclass. This one's similar to the EnumMeta, but much
 # simpler: it's just a place to record subclasses of our Table and
 # Item mount-points.
@@ -244,36 +678,423 @@ class _TableMeta(type):
             # class shouldn't be registered as a plugin. Instead, it sets up a
             # registry where custom plugins can be registered later.
             cls._table_types = collections.defaultdict(lambda: cls)
+            cls._indexes = {}
+            cls._fields = {}
         else:
-            # This must be a plugin implementation, which should be registered.
-            cls._table_types[cls.table_name] = cls
+            # This must be a plugin implementation, which should be
+            # registered, unless it's an abstract one with no table
+            # (like `SnapshotTable`) for others to subclass.
+            if cls.table_name is not None:
+                cls._table_types[cls.table_name] = cls
+            cls._indexes = dict(cls._indexes)
+            cls._fields = dict(cls._fields)
 
             # Special handling for class member fields, if there are
-            # any. A field needs to know what its name is.
-            for name, value in attrs.copy().iteritems():
+            # any. A field needs to know what its name is. So does an
+            # index, unless it was given one explicitly.
+            for name, value in attrs.iteritems():
                 if isinstance(value, Field):
                     value.name = name
+                    cls._fields[name] = value
+                elif isinstance(value, Index):
+                    if value.name is None:
+                        value.name = name
+                    cls._indexes[value.name] = value
+
+
+# Secondary indexes get declared right alongside your fields. Once duo
+# knows which attributes each index is keyed on and which ones it
+# projects, it can work out for itself which index should serve a
+# query, instead of making every caller remember.
+
+
+class QueryPlanWarning(UserWarning):
+    """Issued when a query has to filter on attributes no index is keyed on.
+    """
+
+
+QueryPlan = collections.namedtuple('QueryPlan', 'index key_conditions query_filter cost')
+
+
+class Index(object):
+    """A secondary index, declared on a Table or Item subclass.
+
+    `projection` is `Index.ALL`, `Index.KEYS_ONLY`, or a list of the
+    non-key attribute names the index includes. The index name
+    defaults to the attribute name it's declared under.
+
+    Example::
+
+        class Comment(duo.Item):
+            table_name = 'comments'
+            hash_key_name = 'post_id'
+            range_key_name = 'comment_id'
+
+            by_author = duo.GlobalIndex('author', 'created', projection=['text'])
+            by_date = duo.LocalIndex(range_key='created', name='created-index')
+    """
+    ALL = 'ALL'
+    KEYS_ONLY = 'KEYS_ONLY'
+
+    # Relative read cost of each projection type; smaller projections
+    # mean smaller index entries, and so fewer read capacity units.
+    projection_costs = {KEYS_ONLY: 1, 'INCLUDE': 2, ALL: 3}
+    # Extra cost of fetching non-projected attributes from the table.
+    fetch_cost = 3
+
+    kind = None
+
+    def __init__(self, hash_key=None, range_key=None, projection=ALL, name=None):
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.projection = projection
+        self.name = name
+        super(Index, self).__init__()
+
+    @property
+    def projection_type(self):
+        if self.projection in (self.ALL, self.KEYS_ONLY):
+            return self.projection
+        return 'INCLUDE'
+
+    def get_key_names(self, table):
+        """Return the (hash_key, range_key) names of this index on `table`.
+        """
+        return (self.hash_key, self.range_key)
+
+    def projects(self, table, attributes):
+        """Determine whether all of the named attributes are projected into the index.
+
+        `attributes=None` means the whole item.
+        """
+        if self.projection == self.ALL:
+            return True
+        elif attributes is None:
+            return False
+
+        available = set([table.hash_key_name, table.range_key_name])
+        available.update(self.get_key_names(table))
+        if self.projection != self.KEYS_ONLY:
+            available.update(self.projection)
+        return set(attributes) <= available
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.name)
+
+
+class GlobalIndex(Index):
+    """A global secondary index. Only projected attributes can be read from it.
+    """
+    kind = 'global'
+
+
+class LocalIndex(Index):
+    """A local secondary index. It shares the table's hash key, and
+    DynamoDB fetches non-projected attributes from the table (at a
+    cost).
+    """
+    kind = 'local'
+
+    def __init__(self, range_key=None, projection=Index.ALL, name=None):
+        super(LocalIndex, self).__init__(range_key=range_key, projection=projection, name=name)
+
+    def get_key_names(self, table):
+        return (table.hash_key_name, self.range_key)
+
+
+# What goes in the cache for an item is up to a codec. The default
+# hands a list of (name, value) pairs to the cache client to pickle,
+# as duo always has. MarshalCodec is smaller and faster, and knows when
+# an entry was written for a different schema.
+
+
+class CacheCodec(object):
+    """Converts item data to and from the value stored in the cache.
+    """
+    def dumps(self, item_class, data):
+        raise NotImplementedError()
+
+    def loads(self, item_class, value):
+        """Return the item data, or `None` if the value can't be used.
+        """
+        raise NotImplementedError()
+
+
+class PickleCodec(CacheCodec):
+    """Store a list of (name, value) pairs, and leave the pickling to the cache client.
+    """
+    def dumps(self, item_class, data):
+        return data.items()
+
+    def loads(self, item_class, value):
+        # Anything else was written by some other codec.
+        if not isinstance(value, list):
+            return None
+        try:
+            return dict(value)
+        except (TypeError, ValueError):
+            return None
+
+
+class MarshalCodec(CacheCodec):
+    """A compact, versioned binary format.
+
+    Values of the Item's declared fields are stored positionally, in
+    field-name order, with any other attributes alongside. Entries
+    larger than `compress_threshold` bytes are zlib-compressed.
+
+    Each entry is tagged with the codec version and a hash of the
+    declared field names and the Item's `cache_schema_version`; entries
+    with a different tag are treated as cache misses. Bump
+    `cache_schema_version` when the meaning of stored values changes.
+    """
+    version = 1
+    magic = 'duo'
+    header = struct.Struct('>3sBBI')
+
+    COMPRESSED = 1
+
+    def __init__(self, compress_threshold=1024, compress_level=6):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        super(MarshalCodec, self).__init__()
+
+    def get_schema_tag(self, item_class):
+        field_names = sorted(item_class._fields)
+        return zlib.crc32(repr((field_names, item_class.cache_schema_version))) & 0xffffffff
+
+    def encode_value(self, value):
+        # marshal only does builtin types. Nothing DynamoDB gives us
+        # is a tuple, so tuples tag the rest.
+        if isinstance(value, Decimal):
+            return ('n', str(value))
+        elif isinstance(value, _boto.Binary):
+            return ('b', value.value)
+        elif isinstance(value, (set, frozenset)):
+            return set(self.encode_value(v) for v in value)
+        elif isinstance(value, list):
+            return [self.encode_value(v) for v in value]
+        elif isinstance(value, dict):
+            return dict((k, self.encode_value(v)) for k, v in value.iteritems())
+        return value
+
+    def decode_value(self, value):
+        if isinstance(value, tuple):
+            tag, value = value
+            if tag == 'n':
+                return Decimal(value)
+            return _boto.Binary(value)
+        elif isinstance(value, (set, frozenset)):
+            return set(self.decode_value(v) for v in value)
+        elif isinstance(value, list):
+            return [self.decode_value(v) for v in value]
+        elif isinstance(value, dict):
+            return dict((k, self.decode_value(v)) for k, v in value.iteritems())
+        return value
+
+    def dumps(self, item_class, data):
+        data = dict(data)
+        field_values = tuple(self.encode_value(data.pop(name, None))
+                             for name in sorted(item_class._fields))
+        payload = marshal.dumps((field_values, self.encode_value(data)), 2)
+        flags = 0
+        if self.compress_threshold is not None and len(payload) > self.compress_threshold:
+            payload = zlib.compress(payload, self.compress_level)
+            flags |= self.COMPRESSED
+        return self.header.pack(self.magic, self.version, flags,
+                                self.get_schema_tag(item_class)) + payload
+
+    def loads(self, item_class, value):
+        if not isinstance(value, str) or len(value) < self.header.size:
+            return None
+        magic, version, flags, schema_tag = self.header.unpack_from(value)
+        if (magic, version, schema_tag) != (self.magic, self.version, self.get_schema_tag(item_class)):
+            return None
+
+        payload = value[self.header.size:]
+        try:
+            if flags & self.COMPRESSED:
+                payload = zlib.decompress(payload)
+            field_values, data = marshal.loads(payload)
+            data = self.decode_value(data)
+        except (zlib.error, ValueError, TypeError, EOFError):
+            # Corrupt, or cut short.
+            return None
+        for name, field_value in zip(sorted(item_class._fields), field_values):
+            if field_value is not None:
+                data[name] = self.decode_value(field_value)
+        return data
+
 
+# Wide items are expensive to decode, and most code reads only a few
+# of their attributes. Items with `lazy_decode` keep what DynamoDB
+# sent, and decode each attribute the first time it's read. Whatever
+# was never read is written back, and cached, just as it arrived.
 
-class Item(_Item):
+# Cached entries keep undecoded attributes under this name.
+_RAW_ATTRIBUTES = '__raw__'
+
+
+class _LazyData(collections.MutableMapping):
+    """Item data decoded from DynamoDB's wire format one attribute at a time, as it's read.
+
+    `raw` holds the attributes that haven't been read yet, still encoded.
+    """
+    def __init__(self, raw, dynamizer, decoded=None):
+        self.raw = dict(raw)
+        self.decoded = dict(decoded or {})
+        self.dynamizer = dynamizer
+
+    def __getitem__(self, key):
+        if key in self.raw:
+            # Decode before dropping the raw value, so that other threads always find one or the other.
+            self.decoded[key] = self.dynamizer.decode(self.raw[key])
+            self.raw.pop(key, None)
+        return self.decoded[key]
+
+    def __setitem__(self, key, value):
+        self.raw.pop(key, None)
+        self.decoded[key] = value
+
+    def __delitem__(self, key):
+        if self.raw.pop(key, NONE) is NONE:
+            del self.decoded[key]
+        else:
+            self.decoded.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.decoded or key in self.raw
+
+    def __iter__(self):
+        return iter(set(self.decoded).union(self.raw))
+
+    def __len__(self):
+        return len(set(self.decoded).union(self.raw))
+
+    def __deepcopy__(self, memo):
+        # Raw values are never changed in place, so they can be shared.
+        return _LazyData(self.raw, self.dynamizer, copy.deepcopy(self.decoded, memo))
+
+    def __repr__(self):
+        return '<_LazyData decoded=%r raw=%r>' % (self.decoded, self.raw)
+
+
+class _ItemMixin(object):
     """A boto DynamoDB Item, with caching secret sauce.
 
     Subclass to customize fields and caching behavior. Subclassing
     auto-registers with the DB.
     """
-    # This is the mount-point for custom Items. Sub-classes will
-    # register themselves with this mount-point.
-    __metaclass__ = _TableMeta
+    # Everything duo adds to boto's Item. The real `duo.Item` is built
+    # from this and boto's Item when boto is loaded, and is the
+    # mount-point custom Items register themselves with.
 
     duo_db = None
     duo_table = None
 
     cache = None
     cache_duration = None
+    cache_codec = PickleCodec()
+    cache_schema_version = 0
     is_new = False
 
-    def __init__(self, *args, **kwargs):
-        super(Item, self).__init__(*args, **kwargs)
+    # Set `write_behind = True` for items where losing the last few
+    # writes is acceptable: `put()` then updates the cache immediately
+    # and queues the write, to be sent in batches every
+    # `write_behind_interval` seconds, or whenever
+    # `write_behind_batch_size` writes are waiting. Writes are always
+    # unconditional, and repeated writes to the same key are coalesced.
+    # When `write_behind_max_queue` writes are waiting,
+    # `write_behind_policy` decides what `put()` does: 'block' until
+    # there's room, 'drop' the write (with a warning), or write it
+    # synchronously ('sync').
+    write_behind = False
+    write_behind_interval = 1.0
+    write_behind_batch_size = 25
+    write_behind_max_queue = 10000
+    write_behind_policy = 'block'
+
+    # See `Table.write_shards`.
+    write_shards = None
+
+    # Set `lazy_decode = True` to decode attributes as they're read,
+    # instead of all of them as soon as they're fetched.
+    lazy_decode = False
+
+    # For partial items (see `Table.query(fields=...)`), the names of
+    # the attributes that were actually fetched, and the loader that
+    # fetches the rest.
+    _projected = None
+    _loader = None
+
+    def load(self, data):
+        """Load an item as DynamoDB sent it; with `lazy_decode`, without decoding it yet.
+        """
+        if not self.lazy_decode:
+            return super(_ItemMixin, self).load(data)
+        self._data = _LazyData(data.get('Item', {}), self._dynamizer)
+        self._loaded = True
+        self._orig_data = copy.deepcopy(self._data)
+
+    @contextlib.contextmanager
+    def _read_attributes(self):
+        """Hide the attributes that are still encoded in both `_data` and `_orig_data`.
+
+        Nobody has read them, so they haven't changed, and boto needn't
+        decode them to find that out. Yields their names.
+        """
+        data, orig_data = self._data, self._orig_data
+        if not (isinstance(data, _LazyData) and isinstance(orig_data, _LazyData)):
+            yield set()
+            return
+
+        unread = set(name for name, value in data.raw.items() if orig_data.raw.get(name) == value)
+        self._data = dict((name, data[name]) for name in data if name not in unread)
+        self._orig_data = dict((name, orig_data[name]) for name in orig_data if name not in unread)
+        try:
+            yield unread
+        finally:
+            self._data, self._orig_data = data, orig_data
+
+    def _determine_alterations(self):
+        with self._read_attributes():
+            return super(_ItemMixin, self)._determine_alterations()
+
+    def build_expects(self, fields=None):
+        orig_data = self._orig_data
+        with self._read_attributes() as unread:
+            if fields is None:
+                fields = list(self._data.keys()) + list(self._orig_data.keys()) + list(unread)
+            expects = super(_ItemMixin, self).build_expects([name for name in fields if name not in unread])
+        for name in unread.intersection(fields):
+            expects[name] = {'Exists': True, 'Value': orig_data.raw[name]}
+        return expects
+
+    def prepare_full(self):
+        data = self._data
+        if not isinstance(data, _LazyData):
+            return super(_ItemMixin, self).prepare_full()
+        final_data = {}
+        for name in data:
+            value = data.raw.get(name)
+            if value is not None:
+                final_data[name] = value
+            elif self._is_storable(data[name]):
+                final_data[name] = self._dynamizer.encode(data[name])
+        return final_data
+
+    @property
+    def is_partial(self):
+        """True if only some of the item's attributes have been fetched.
+        """
+        return self._projected is not None
+
+    def _load_missing(self):
+        """Fetch the attributes a partial item is missing.
+        """
+        if self._loader is None:
+            _PartialLoader(self.duo_table).add(self)
+        self._loader.load(self)
 
     def pop(self, key, default):
         """Pops a value from the dict, and returns it
@@ -302,52 +1123,445 @@ class Item(_Item):
     def _cache_key(self):
         """Determine the key for accessing the item in the cache.
         """
-        return self.duo_table._get_cache_key(self.hash_key, self.range_key)
+        table = self.duo_table
+        return table._make_cache_key(self[table.hash_key_name], self.get(table.range_key_name, None))
+
+    def _cache_payload(self):
+        """Return what gets stored in the cache for this item.
+        """
+        data = self._data
+        if isinstance(data, _LazyData):
+            decoded = dict((name, data[name]) for name in data.decoded.keys() if name in data)
+            decoded[_RAW_ATTRIBUTES] = dict(data.raw)
+            return self.cache_codec.dumps(self.__class__, decoded)
+        return self.cache_codec.dumps(self.__class__, dict(self.items()))
 
     def _set_cache(self):
         """Store the item in the cache.
         """
+        if self.is_partial:
+            return
         if self.cache is not None and self.cache_duration is not None:
-            table = self.duo_table
-            key = table._get_cache_key(self[table.hash_key_name], self.get(table.range_key_name, None))
-            duration = self.cache_duration if self.cache_duration is not None else table.cache_duration
-            self.cache.set(key, self.items(), duration)
+            self.cache.set(self._cache_key, self._cache_payload(), self.cache_duration)
 
     def _delete_cache(self):
         """Remove the item from the cache.
         """
         if self.cache is not None:
-            table = self.duo_table
-            key = table._get_cache_key(self[table.hash_key_name], self.get(table.range_key_name, None))
-            self.cache.delete(key)
+            self.cache.delete(self._cache_key)
+
+    def _drop_partition(self):
+        """Remove the item's partition from the partition cache, if there is one.
+        """
+        table = self.duo_table
+        table._drop_partitions([self[table.hash_key_name]])
 
+    @_traced('put')
     def put(self, *args, **kwargs):
         """Put the item in the database, and also in the cache.
+
+        A partial item only writes the attributes that changed, so
+        that the ones it never fetched are left alone.
         """
-        result = super(Item, self).save(*args, **kwargs)
+        if self.write_behind and not self.is_partial:
+            result = self._put_behind()
+            if result is not None:
+                return result
+
+        with self._sharded():
+            if self.is_partial:
+                result = super(_ItemMixin, self).partial_save()
+            else:
+                result = super(_ItemMixin, self).save(*args, **kwargs)
         if not result:
             # Den petixe i apothikefsi, i brethike allo peiragmeno item apo katw
             # Gia ipoxrewtikki antikatastasi overwrite=True
             return False
         self.is_new = False
+        if self.duo_table.key_filter:
+            self.duo_table._add_to_key_filter(self)
         try:
             self._set_cache()
+            self._drop_partition()
         except Exception as e:
             warnings.warn('Cache write-through failed on put(). %s: %s' % (e.__class__.__name__, e.message))
         return result
 
+    def _put_behind(self):
+        """Queue the item to be written by the write-behind flusher.
+
+        Returns `None` if it should be written synchronously instead.
+        """
+        queue = self.duo_db._get_write_behind_queue(self)
+        with self._sharded():
+            data = copy.deepcopy(self._data)
+        queued = queue.put(self._write_behind_key, data, self.write_behind_policy)
+        if queued is None:
+            return None
+        elif not queued:
+            warnings.warn('Write-behind queue for %s is full; dropped a put().' % self.duo_table.table_name)
+            return False
+
+        self.is_new = False
+        self.mark_clean()
+        if self.duo_table.key_filter:
+            self.duo_table._add_to_key_filter(self)
+        try:
+            self._set_cache()
+            self._drop_partition()
+        except Exception as e:
+            warnings.warn('Cache write-through failed on put(). %s: %s' % (e.__class__.__name__, e.message))
+        return True
+
+    @contextlib.contextmanager
+    def _sharded(self):
+        """Swap in the item's sharded hash key while it's being written, if the table is sharded.
+        """
+        table = self.duo_table
+        if not table._get_item_shards():
+            yield
+            return
+
+        hash_key_name = table.hash_key_name
+        hash_key = self[hash_key_name]
+        sharded = table._shard_key(hash_key, table._shard_for(self[table.range_key_name]))
+        self._data[hash_key_name] = sharded
+        if hash_key_name in self._orig_data:
+            self._orig_data[hash_key_name] = sharded
+        try:
+            yield
+        finally:
+            table._unshard(self)
+
+    @property
+    def _write_behind_key(self):
+        table = self.duo_table
+        return (self[table.hash_key_name], self.get(table.range_key_name, None))
+
+    @_traced('delete')
     def delete(self, *args, **kwargs):
         """Delete the item from the database, and also from the cache.
         """
-        result = super(Item, self).delete(*args, **kwargs)
+        if self.write_behind and self.duo_table.table_name in self.duo_db._write_behind:
+            # Don't let a queued put bring it back.
+            self.duo_db._get_write_behind_queue(self).discard(self._write_behind_key)
+        with self._sharded():
+            result = super(_ItemMixin, self).delete(*args, **kwargs)
         self.is_new = True
         try:
             self._delete_cache()
+            self._drop_partition()
         except Exception as e:
             warnings.warn('Cache write-through failed on delete(). %s: %s' % (e.__class__.__name__, e.message))
         return result
 
 
+class _DeferredItemMeta(_TableMeta):
+    """The metaclass of `duo.Item` until boto is loaded.
+
+    Declaring a subclass loads boto and builds the class on the real
+    `duo.Item` instead; everything else is passed along to it.
+    """
+    def __new__(mcs, name, bases, attrs):
+        if not any(isinstance(base, _DeferredItemMeta) for base in bases):
+            # The stand-in itself.
+            return type.__new__(mcs, name, bases, attrs)
+        bases = tuple(_boto.Item if isinstance(base, _DeferredItemMeta) else base for base in bases)
+        return _TableMeta(name, bases, attrs)
+
+    def __init__(cls, name, bases, attrs):
+        # The stand-in isn't a mount-point; the real `duo.Item` is.
+        pass
+
+    def __call__(cls, *args, **kwargs):
+        return _boto.Item(*args, **kwargs)
+
+    def __getattr__(cls, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(_boto.Item, name)
+
+    def __instancecheck__(cls, instance):
+        return isinstance(instance, _boto.Item)
+
+    def __subclasscheck__(cls, subclass):
+        return issubclass(subclass, _boto.Item)
+
+
+class Item(object):
+    """A boto DynamoDB Item, with caching secret sauce.
+
+    Subclass to customize fields and caching behavior. Subclassing
+    auto-registers with the DB.
+    """
+    # Stands in for the real `duo.Item` until boto is loaded.
+    __metaclass__ = _DeferredItemMeta
+
+
+class _RateLimiter(object):
+    """A thread-safe token bucket, refilled at `rate` units per second.
+
+    `rate=None` means no limit.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate or 0
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, units=1):
+        """Block until `units` are available, then spend them.
+        """
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= min(units, self.rate):
+                    self.tokens -= units
+                    return
+                wait = (min(units, self.rate) - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_thread_pools = {}
+_thread_pools_lock = threading.Lock()
+
+
+def _get_thread_pool(size):
+    """Return a shared pool of `size` threads, for fanning out requests.
+    """
+    with _thread_pools_lock:
+        if size not in _thread_pools:
+            from multiprocessing.pool import ThreadPool
+            _thread_pools[size] = ThreadPool(size)
+        return _thread_pools[size]
+
+
+class _LatencyTracker(object):
+    """Keeps the most recent request latencies, for estimating percentiles.
+    """
+    def __init__(self, size=1000, min_samples=20):
+        self.samples = collections.deque(maxlen=size)
+        self.min_samples = min_samples
+        self.requests = 0
+        self.hedges = 0
+        self._percentiles = {}
+        self._added = 0
+
+    def add(self, latency):
+        self.samples.append(latency)
+        self._added += 1
+        if self._added % 50 == 0:
+            self._percentiles.clear()
+
+    def percentile(self, percent):
+        """Return the given percentile of recent latencies, or `None` if there are too few.
+
+        Recomputed every 50 samples, rather than on every request.
+        """
+        if len(self.samples) < self.min_samples:
+            return None
+        if percent not in self._percentiles:
+            samples = sorted(self.samples)
+            self._percentiles[percent] = samples[min(len(samples) - 1, len(samples) * percent // 100)]
+        return self._percentiles[percent]
+
+
+def _chunks(iterable, size):
+    """Split an iterable into lists of at most `size` items.
+    """
+    chunk = []
+    for value in iterable:
+        chunk.append(value)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _range_bounds(range_keys, conditions):
+    """Return the slice of a sorted list of range keys that meets `conditions`.
+
+    Conditions are `(operator, value)` pairs, as for `_Snapshot.find()`.
+    """
+    lo, hi = 0, len(range_keys)
+    for operator, value in conditions:
+        if operator == 'between':
+            lo = bisect.bisect_left(range_keys, value[0], lo, hi)
+            hi = bisect.bisect_right(range_keys, value[1], lo, hi)
+        elif operator == 'eq':
+            lo = bisect.bisect_left(range_keys, value, lo, hi)
+            hi = bisect.bisect_right(range_keys, value, lo, hi)
+        elif operator == 'gte':
+            lo = bisect.bisect_left(range_keys, value, lo, hi)
+        elif operator == 'gt':
+            lo = bisect.bisect_right(range_keys, value, lo, hi)
+        elif operator == 'lte':
+            hi = bisect.bisect_right(range_keys, value, lo, hi)
+        elif operator == 'lt':
+            hi = bisect.bisect_left(range_keys, value, lo, hi)
+        elif operator == 'beginswith':
+            lo = bisect.bisect_left(range_keys, value, lo, hi)
+            end = lo
+            while end < hi and range_keys[end].startswith(value):
+                end += 1
+            hi = end
+    return lo, max(lo, hi)
+
+
+class _WriteBehindQueue(object):
+    """Buffers puts to a table, and writes them in batches from a background thread.
+
+    Pending puts are keyed by item key, so a later put of the same
+    item replaces an earlier one that hasn't been written yet.
+    """
+    def __init__(self, table, interval=1.0, batch_size=25, max_size=10000):
+        self.table = table
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_size = max_size
+        self.pending = collections.OrderedDict()
+        self.condition = threading.Condition()
+        self.flushing = threading.Lock()
+        self.closed = False
+
+        self.thread = threading.Thread(target=self.run, name='duo-write-behind-%s' % table.table_name)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, key, data, policy='block'):
+        """Queue `data` to be written under `key`.
+
+        Returns `True` if it was queued. If the queue is full, `policy`
+        decides: 'block' waits for room, 'drop' returns `False`, and
+        'sync' returns `None`, for the caller to write it directly.
+        """
+        with self.condition:
+            while key not in self.pending and len(self.pending) >= self.max_size:
+                if policy == 'drop':
+                    return False
+                elif policy == 'sync':
+                    return None
+                self.condition.notify_all()
+                self.condition.wait(self.interval)
+
+            self.pending[key] = data
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify_all()
+        return True
+
+    def discard(self, key):
+        """Forget a pending put, if there is one.
+        """
+        with self.condition:
+            self.pending.pop(key, None)
+
+    def run(self):
+        while not self.closed:
+            with self.condition:
+                if len(self.pending) < self.batch_size and not self.closed:
+                    self.condition.wait(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                warnings.warn('Write-behind flush failed. %s: %s' % (e.__class__.__name__, e))
+
+    def close(self):
+        """Stop the background thread, and write whatever's pending.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(self.interval)
+        self.flush()
+
+    def flush(self):
+        """Write all pending puts now.
+        """
+        with self.flushing:
+            with self.condition:
+                pending, self.pending = self.pending, collections.OrderedDict()
+                self.condition.notify_all()
+            if not pending:
+                return
+
+            try:
+                with self.table.batch_write() as batch:
+                    for data in pending.itervalues():
+                        batch.put_item(data, overwrite=True)
+            except Exception:
+                # Put them back for the next try, unless they've been superseded.
+                with self.condition:
+                    for key, data in pending.iteritems():
+                        self.pending.setdefault(key, data)
+                raise
+
+
+class _PartialLoader(object):
+    """Fetches the rest of a group of partial items, in batches.
+
+    Items that came back from the same query or scan share a loader,
+    so that the first partial item to be read fills in its siblings
+    with the same request.
+    """
+    max_batch = 100
+
+    def __init__(self, table):
+        self.table = table
+        self.items = weakref.WeakValueDictionary()
+
+    def add(self, item):
+        item._loader = self
+        self.items[id(item)] = item
+        return item
+
+    def _get_key(self, item):
+        table = self.table
+        if table.range_key_name is None:
+            return (item[table.hash_key_name], )
+        else:
+            return (item[table.hash_key_name], item[table.range_key_name])
+
+    def load(self, item):
+        """Fetch the missing attributes of `item`, and of up to `max_batch` of its siblings.
+        """
+        batch = {self._get_key(item): item}
+        for other in self.items.values():
+            if len(batch) >= self.max_batch:
+                break
+            elif other.is_partial:
+                batch[self._get_key(other)] = other
+
+        loaded = set()
+        for result in self.table._batch_get(batch.keys()):
+            key = self._get_key(result)
+            partial = batch.get(key)
+            if partial is None:
+                continue
+            loaded.add(key)
+            for name, value in result.items():
+                if name not in partial._orig_data:
+                    partial._orig_data[name] = copy.deepcopy(value)
+                    if name not in partial._data:
+                        partial._data[name] = value
+
+        for key, partial in batch.iteritems():
+            if key not in loaded:
+                # Gone from the table, or not returned this time: it stays
+                # partial, and mustn't be cached as if it were whole.
+                partial._delete_cache()
+                continue
+            partial._projected = None
+            partial._loader = None
+            self.items.pop(id(partial), None)
+            partial._set_cache()
+
+
 class Table(object):
     """A DynamoDB Table, with super dict-like powers.
 
@@ -365,6 +1579,80 @@ class Table(object):
     cache = None
     cache_prefix = None
 
+    # Set `cache_generations = True` to mix a generation number, stored
+    # in the cache, into every cache key. `invalidate_all()` bumps it,
+    # orphaning every cached item in one go. Each process holds on to
+    # the generation for `cache_generation_ttl` seconds, so other
+    # processes may see the old one for that long.
+    cache_generations = False
+    cache_generation_ttl = 5
+
+    # Generations held in this process, by cache prefix: (generation, expires).
+    _generations = {}
+
+    # Set `write_shards = N` (here or on the Item) to spread the items
+    # of each hash key over N hash keys, `<hash_key>#0` through
+    # `<hash_key>#N-1`, for hash keys that take more writes than one
+    # partition can. An item's shard is picked by its range key, so
+    # fetching a single item still takes one read; queries on a hash
+    # key are sent to every shard in parallel, and the results merged.
+    # On a hash-only table, shards are only for `counter()`s. Sharded
+    # hash keys have to be strings (DynamoDB type S). Items written
+    # before sharding was turned on keep their hash keys, and are only
+    # found by scans.
+    write_shards = None
+    shard_separator = '#'
+    shard_concurrency = 8
+
+    # Set `hedge_after` to a number of seconds, or to 'p95' to use the
+    # 95th percentile of recent read latencies, to hedge single-item
+    # and batched reads: if no answer has arrived by then, the same
+    # read is sent again, and whichever answer arrives first is used.
+    # No more than `hedge_budget` of all reads are hedged.
+    hedge_after = None
+    hedge_budget = 0.05
+
+    # Recent read latencies, by table name.
+    _latencies = {}
+
+    # Set `key_filter = True` to keep a Bloom filter of the table's
+    # keys (see `KeyFilter`), so that looking up a key that definitely
+    # doesn't exist skips the read and goes straight to `create()`.
+    # `build_key_filter()` fills one from a parallel scan and stores it
+    # at `key_filter_path`, or in the cache if that's `None`; each
+    # process re-reads it every `key_filter_ttl` seconds. A key filter
+    # needs a cache, shared by every process that writes the table:
+    # each put appends its key to a log there, which every lookup
+    # catches up on, so keys written since the build aren't skipped.
+    # If the cache loses part of the log, the filter isn't used until
+    # the next build. Deleted keys linger, so rebuild at least every
+    # `key_filter_max_age` seconds (a filter older than that isn't
+    # used, and the log keeps entries that long).
+    key_filter = False
+    key_filter_capacity = 100000
+    key_filter_error_rate = 0.01
+    key_filter_path = None
+    key_filter_ttl = 60
+    key_filter_max_age = 24 * 60 * 60
+
+    # Key filters held in this process, by table name: (filter,
+    # expires, position in the log it's caught up to).
+    _key_filters = {}
+
+    # Set `partition_cache = True` on a table with a range key to also
+    # cache all the items of a hash key together, sorted by range key,
+    # for `partition_cache_duration` seconds. Queries on a hash key with
+    # at most one range key condition (and `Table[hash_key]`) are then
+    # answered from the cache with a binary search, `reverse` and
+    # `limit` included; the first one on a hash key reads its whole
+    # partition. Hash keys with more than `partition_cache_max_items`
+    # items aren't cached. `Item.put()` and `.delete()` drop the cached
+    # partition of the item, but a partition being read while it's
+    # written can be cached stale, so keep the duration short.
+    partition_cache = False
+    partition_cache_duration = 60
+    partition_cache_max_items = 1000
+
     def __init__(self, db, table, cache=None):
         self.duo_db = db
         self.table = table
@@ -410,7 +1698,6 @@ class Table(object):
         data[self.hash_key_name] = hash_key
         if self.range_key_name and range_key:
             data[self.range_key_name] = range_key
-        # item = _Item(self.table, data = data)
         return self._extend(Item._table_types[self.table_name](self.table, data = data), is_new=True)
 
         """
@@ -441,53 +1728,243 @@ class Table(object):
             yield self._extend(item, is_new)
 
     @classmethod
-    def _get_cache_key(cls, hash_key, range_key):
+    def _get_cache_key(cls, hash_key, range_key, generation=None):
         """Determine the cache key for a given table key.
 
         Specify `range_key=None` for a hash-only key.
         """
+        prefix = cls.cache_prefix or cls.table_name
+        if generation is not None:
+            prefix = '%s@%s' % (prefix, generation)
         if range_key is None:
-            key = '%s_%s' % (cls.cache_prefix or cls.table_name, hash_key)
+            key = '%s_%s' % (prefix, hash_key)
         else:
-            key = '%s_%s_%s' % (cls.cache_prefix or cls.table_name, hash_key, range_key)
+            key = '%s_%s_%s' % (prefix, hash_key, range_key)
         return hashlib.sha224(key).hexdigest()
 
+    def _make_cache_key(self, hash_key, range_key):
+        """Determine the cache key for a given table key, in the current generation.
+        """
+        return self._get_cache_key(hash_key, range_key, self._get_generation())
+
+    @property
+    def _generation_key(self):
+        return self._get_cache_key('__generation__', None)
+
+    def _get_generation(self):
+        """Return the current cache generation, or `None` if generations are off.
+        """
+        if not self.cache_generations or self.cache is None:
+            return None
+
+        prefix = self.cache_prefix or self.table_name
+        now = time.time()
+        generation, expires = self._generations.get(prefix, (None, 0))
+        if now < expires:
+            return generation
+
+        generation = self.cache.get(self._generation_key)
+        if generation is None:
+            # Start from the clock, so a fresh cache never revives an old generation.
+            generation = int(now * 1000)
+            if hasattr(self.cache, 'add'):
+                if not self.cache.add(self._generation_key, generation, 0):
+                    # Somebody beat us to it.
+                    generation = self.cache.get(self._generation_key) or generation
+            else:
+                self.cache.set(self._generation_key, generation, 0)
+
+        self._generations[prefix] = (generation, now + self.cache_generation_ttl)
+        return generation
+
+    def invalidate_all(self):
+        """Invalidate every cached item in this table, by starting a new cache generation.
+
+        Requires `cache_generations = True`. Returns the new generation.
+        """
+        if not self.cache_generations:
+            raise ValueError("Set cache_generations = True on '%s' to use invalidate_all()." % (
+                self.table_name))
+
+        try:
+            generation = self.cache.incr(self._generation_key)
+        except Exception:
+            # Some clients raise, rather than return None, if the key's missing.
+            generation = None
+        if generation is None:
+            generation = int(time.time() * 1000)
+            self.cache.set(self._generation_key, generation, 0)
+
+        self._generations[self.cache_prefix or self.table_name] = (
+            generation, time.time() + self.cache_generation_ttl)
+        return generation
+
     def _get_cache(self, hash_key, range_key=None):
         """Retrieve the specified item from the cache, if available.
         """
         if self.cache is None:
             return None
         else:
-            key = self._get_cache_key(hash_key, range_key)
+            key = self._make_cache_key(hash_key, range_key)
             cached = self.cache.get(key)
+            item_class = Item._table_types[self.table_name]
             if cached is not None:
-                # Build an Item.
-
-                data = dict(cached)
-                cached = self._extend(Item._table_types[self.table_name](self.table, data = data, loaded = True))
+                cached = item_class.cache_codec.loads(item_class, cached)
+                if cached is None:
+                    # Written in some other format; as good as missing.
+                    self.duo_db.stats['cache_stale'] += 1
+            if cached is not None:
+                self.duo_db.stats['cache_hits'] += 1
+                cached = self._cached_item(item_class, cached)
+            else:
+                self.duo_db.stats['cache_misses'] += 1
             return cached
 
+    def _cached_item(self, item_class, data):
+        """Build an Item from decoded cache data.
+        """
+        if _RAW_ATTRIBUTES in data:
+            data = _LazyData(data.pop(_RAW_ATTRIBUTES), self.table._dynamizer, data)
+            if not item_class.lazy_decode:
+                data = dict(data.items())
+        return self._extend(item_class(self.table, data = data, loaded = True))
 
-    def get_item(self, hash_key, range_key=None, consistent=False, attributes=None, **params):
-        data = {}
-        data[self.hash_key_name] = hash_key
-        if self.range_key_name and range_key:
-            data[self.range_key_name] = range_key
+    def _partition_cache_key(self, hash_key):
+        return self._make_cache_key('__partition__', hash_key)
 
-        raw_key = self.table._encode_keys(data)
-        item_data = self.table.connection.get_item(
-            self.table_name,
-            raw_key,
-            attributes_to_get=attributes,
-            consistent_read=consistent
-        )
-        if 'Item' not in item_data:
-            raise ItemNotFound("Item (%s, %s) couldn't be found." % (hash_key, range_key))
-        item = self._extend(Item._table_types[self.table_name](self.table))
+    def _get_partition(self, hash_key):
+        """Return the range keys and cached items of a hash key, from the partition cache.
+
+        Reads and caches the whole partition on a miss. Returns `None`
+        if it has too many items to cache.
+        """
+        item_class = Item._table_types[self.table_name]
+        key = self._partition_cache_key(hash_key)
+        cached = self.cache.get(key)
+        if cached is not None and cached['items'] is not None:
+            payloads = [item_class.cache_codec.loads(item_class, payload) for payload in cached['items']]
+            if None in payloads:
+                # Written in some other format; as good as missing.
+                self.duo_db.stats['cache_stale'] += 1
+                cached = None
+            else:
+                cached = dict(cached, items=payloads)
+        if cached is not None:
+            self.duo_db.stats['partition_cache_hits'] += 1
+            return cached if cached['items'] is not None else None
+
+        self.duo_db.stats['partition_cache_misses'] += 1
+        items = list(self._query(limit=self.partition_cache_max_items + 1,
+                                 **{'%s__eq' % self.hash_key_name: hash_key}))
+        if len(items) > self.partition_cache_max_items:
+            self.cache.set(key, {'range_keys': None, 'items': None}, self.partition_cache_duration)
+            return None
+
+        items = [item if isinstance(item, Item) else self._extend(item_class(self.table, data=item, loaded=True))
+                 for item in items]
+        items.sort(key=lambda item: item[self.range_key_name])
+        range_keys = [item[self.range_key_name] for item in items]
+        self.cache.set(key, {'range_keys': range_keys,
+                             'items': [item._cache_payload() for item in items]},
+                       self.partition_cache_duration)
+        return {'range_keys': range_keys, 'items': items}
+
+    def _drop_partitions(self, hash_keys):
+        """Remove the cached partitions of some hash keys.
+        """
+        if not self.partition_cache or self.cache is None:
+            return
+        for hash_key in set(hash_keys):
+            self.cache.delete(self._partition_cache_key(hash_key))
+
+    def _query_partition(self, hash_key, conditions, reverse, limit):
+        """Answer a query on a hash key from the partition cache, or return `None` if it can't be.
+        """
+        partition = self._get_partition(hash_key)
+        if partition is None:
+            return None
+
+        item_class = Item._table_types[self.table_name]
+        lo, hi = _range_bounds(partition['range_keys'], conditions)
+        items = partition['items'][lo:hi]
+        if reverse:
+            items.reverse()
+        if limit:
+            items = items[:limit]
+        return [item if isinstance(item, Item) else self._cached_item(item_class, item) for item in items]
+
+    def _range_conditions(self, filter_kwargs):
+        """Split query conditions into a hash key and at most one range key condition.
+
+        Returns `(hash_key, [(operator, value)])`, or `None` if there
+        are any other conditions.
+        """
+        hash_key = filter_kwargs.get('%s__eq' % self.hash_key_name)
+        conditions = [(name.rpartition('__')[2], value) for name, value in filter_kwargs.iteritems()
+                      if name.rpartition('__')[0] == self.range_key_name]
+        if (hash_key is None or len(conditions) + 1 != len(filter_kwargs) or len(conditions) > 1
+                or not all(operator in _KEY_OPERATORS for operator, _ in conditions)):
+            return None
+        return hash_key, conditions
+
+
+    def _get_field_names(self, fields):
+        """Return the attribute names for a list of `Field`s (or names), plus the key names.
+        """
+        names = set(getattr(field, 'name', field) for field in fields)
+        names.add(self.hash_key_name)
+        if self.range_key_name is not None:
+            names.add(self.range_key_name)
+        return sorted(names)
+
+    def _extend_partial(self, items, names):
+        """Convert boto Items fetched with a projection into partial Items.
+        """
+        loader = _PartialLoader(self)
+        item_class = Item._table_types[self.table_name]
+        for item in items:
+            item = self._extend(item_class(self.table, data=item, loaded=True))
+            item._projected = frozenset(names)
+            yield loader.add(item)
+
+    @_traced('get_item')
+    def get_item(self, hash_key, range_key=None, consistent=False, attributes=None, fields=None, **params):
+        """Fetch an item from the table, bypassing (but populating) the cache.
+
+        Pass `fields` (a list of `Field`s or attribute names) to fetch
+        only those attributes. The item is then partial: reading any
+        other field fetches the rest of it.
+        """
+        if fields is not None:
+            attributes = self._get_field_names(fields)
+
+        data = {}
+        data[self.hash_key_name] = hash_key
+        if self.range_key_name and range_key:
+            data[self.range_key_name] = range_key
+
+        if self._get_item_shards():
+            data[self.hash_key_name] = self._shard_key(hash_key, self._shard_for(range_key))
+
+        raw_key = self.table._encode_keys(data)
+        item_data = self._hedged(
+            self.table.connection.get_item,
+            self.table_name,
+            raw_key,
+            attributes_to_get=attributes,
+            consistent_read=consistent
+        )
+        if 'Item' not in item_data:
+            raise _boto.ItemNotFound("Item (%s, %s) couldn't be found." % (hash_key, range_key))
+        item = self._extend(Item._table_types[self.table_name](self.table))
         item.load(item_data)
+        self._unshard(item)
+        if fields is not None:
+            item._projected = frozenset(attributes)
         item._set_cache()
-        return item        
+        return item
 
+    @_traced('get')
     def __getitem__(self, key):
         if isinstance(key, tuple):
             hash_key, range_key = key
@@ -500,28 +1977,322 @@ class Table(object):
         if cached is not None:
             return cached
 
+        if range_key is None and self.range_key_name is not None:
+            return self.query(**{'%s__eq' % self.hash_key_name: hash_key})
+
+        # Don't bother asking for a key that definitely isn't there.
+        key_filter = self.get_key_filter()
+        if key_filter is not None and (hash_key, range_key) not in key_filter:
+            self.duo_db.stats['key_filter_skips'] += 1
+            return self.create(hash_key, range_key)
+
         try:
-            if range_key is None:
-                if self.range_key_name is None:
-                    item = self.get_item(hash_key)
-                else:
-                    return self.query(hash_key)
-            else:
-                item = self.get_item(hash_key, range_key)
+            item = self.get_item(hash_key, range_key)
         except ItemNotFound:
+            if key_filter is not None:
+                # A false positive.
+                self.duo_db.stats['key_filter_misses'] += 1
             item = self.create(hash_key, range_key)
 
         return item
 
+    @property
+    def _key_filter_cache_key(self):
+        return self._get_cache_key('__key_filter__', None)
+
+    def _key_filter_log_key(self, position=None):
+        return self._get_cache_key('__key_filter_log__', position)
+
+    def _key_filter_log_position(self):
+        """Return the position of the last key appended to the key filter log.
+        """
+        position = self.cache.get(self._key_filter_log_key())
+        if position is None:
+            # Start from the clock, so a fresh log never reuses positions.
+            position = int(time.time() * 1000)
+            if not self.cache.add(self._key_filter_log_key(), position, 0):
+                position = self.cache.get(self._key_filter_log_key()) or position
+        return position
+
+    def _catch_up_key_filter(self, key_filter, position):
+        """Add keys appended to the log after `position` to `key_filter`.
+
+        Returns the new position, or `None` if the log has lost any keys.
+        """
+        last = self._key_filter_log_position()
+        if last < position or last - position > self.key_filter_capacity:
+            return None
+
+        # Every key up to the count is there, unless it's been evicted.
+        keys = [self._key_filter_log_key(i) for i in range(position + 1, last + 1)]
+        found = self.cache.get_multi(keys) if keys else {}
+        if len(found) < len(keys):
+            return None
+        for key in keys:
+            key_filter.add(tuple(found[key]))
+
+        # Writers count their keys after appending them, so there may be a few more.
+        while True:
+            key = self.cache.get(self._key_filter_log_key(last + 1))
+            if key is None:
+                return last
+            key_filter.add(tuple(key))
+            last += 1
+
+    def _load_key_filter(self):
+        """Read the stored key filter, or return `None` if there isn't one.
+        """
+        if self.key_filter_path is not None:
+            try:
+                with open(self.key_filter_path, 'rb') as f:
+                    value = f.read()
+            except IOError:
+                return None
+        elif self.cache is not None:
+            value = self.cache.get(self._key_filter_cache_key)
+            if value is None:
+                return None
+        else:
+            return None
+        return KeyFilter.loads(value)
+
+    def _store_key_filter(self, key_filter):
+        value = key_filter.dumps()
+        if self.key_filter_path is not None:
+            # Write and rename, so readers never see half a filter.
+            temp = '%s.%d.tmp' % (self.key_filter_path, os.getpid())
+            with open(temp, 'wb') as f:
+                f.write(value)
+            os.rename(temp, self.key_filter_path)
+        elif self.cache is not None:
+            self.cache.set(self._key_filter_cache_key, value, 0)
+        else:
+            raise ValueError("Set key_filter_path or a cache on '%s' to store its key filter." % (
+                self.table_name))
+
+    def get_key_filter(self):
+        """Return this table's current `KeyFilter`, or `None` if there isn't one to use.
+
+        Keys put by any process since the filter was built are in it.
+        """
+        if not self.key_filter:
+            return None
+        if self.cache is None:
+            raise ValueError("Set a cache on '%s' to use its key filter." % self.table_name)
+
+        now = time.time()
+        key_filter, expires, position = self._key_filters.get(self.table_name, (None, 0, None))
+        if now >= expires:
+            stored = self._load_key_filter()
+            if stored is not None and (key_filter is None or stored.built > key_filter.built):
+                key_filter, position = stored, stored.position
+            expires = now + self.key_filter_ttl
+
+        if key_filter is not None and position is not None:
+            position = self._catch_up_key_filter(key_filter, position)
+            if position is None:
+                self.duo_db.stats['key_filter_lost'] += 1
+        self._key_filters[self.table_name] = (key_filter, expires, position)
+
+        if key_filter is None or position is None or now - key_filter.built > self.key_filter_max_age:
+            return None
+        return key_filter
+
+    def _add_to_key_filter(self, item):
+        """Append a newly written item's key to the key filter log, for every process's filter.
+        """
+        if self.cache is None:
+            raise ValueError("Set a cache on '%s' to use its key filter." % self.table_name)
+
+        key = (item[self.hash_key_name], item.get(self.range_key_name) if self.range_key_name else None)
+        position = self._key_filter_log_position() + 1
+        # Claim the next free slot: `add` only writes to an empty one.
+        while not self.cache.add(self._key_filter_log_key(position), key, self.key_filter_max_age):
+            position += 1
+        self.cache.incr(self._key_filter_log_key())
+
+    def build_key_filter(self, concurrency=4):
+        """Build a new key filter from a parallel scan of the table's keys, and store it.
+
+        Run it regularly, e.g. `duo build-key-filter <table>` from cron.
+        Returns the new `KeyFilter`.
+        """
+        key_filter = KeyFilter.for_capacity(self.key_filter_capacity, self.key_filter_error_rate)
+        # Keys put from here on may be missed by the scan, but not by the log.
+        key_filter.position = self._key_filter_log_position()
+        key_names = [name for name in (self.hash_key_name, self.range_key_name) if name is not None]
+
+        def scan_segment(segment):
+            for item in self.scan(segment=segment, total_segments=concurrency, attributes=key_names):
+                key_filter.add((item[self.hash_key_name],
+                                item[self.range_key_name] if self.range_key_name else None))
+
+        _get_thread_pool(concurrency).map(self.duo_db._carry_capacity_tag(scan_segment), range(concurrency))
+        self._store_key_filter(key_filter)
+        self._key_filters.pop(self.table_name, None)
+        return key_filter
+
+    def snapshot(self, path, concurrency=4):
+        """Write every item in the table to a snapshot file at `path`, for a `SnapshotTable` to read.
+
+        The table is read with a parallel scan in `concurrency`
+        segments. The file is replaced atomically, so readers of the
+        old one are undisturbed. Returns the number of items written.
+        """
+        records = []
+        lock = threading.Lock()
+
+        def scan_segment(segment):
+            segment_records = [
+                (item[self.hash_key_name], item[self.range_key_name] if self.range_key_name else None,
+                 item.prepare_full())
+                for item in self.scan(segment=segment, total_segments=concurrency)]
+            with lock:
+                records.extend(segment_records)
+
+        _get_thread_pool(concurrency).map(self.duo_db._carry_capacity_tag(scan_segment), range(concurrency))
+        _Snapshot.write(path, records)
+        return len(records)
+
+    def _get_indexes(self):
+        """Return all secondary indexes declared on this table and its Item class, by name.
+        """
+        indexes = dict(Item._table_types[self.table_name]._indexes)
+        indexes.update(self._indexes)
+        return indexes
+
+    def plan_query(self, attributes=None, **filter_kwargs):
+        """Choose the cheapest way to serve a query with the given conditions.
+
+        Every candidate (the table itself, or a declared index) needs
+        an `eq` condition on its hash key. Conditions that can't be
+        key conditions on a candidate become query filters, which cost
+        read capacity for every item they throw away, so they weigh
+        heavily against it. Returns a `QueryPlan`; `index` is `None`
+        for the table itself.
+        """
+        conditions = []
+        for field_and_op, value in filter_kwargs.iteritems():
+            field, _, op = field_and_op.rpartition('__')
+            conditions.append((field, op, field_and_op, value))
+
+        candidates = [(None, self.hash_key_name, self.range_key_name)]
+        candidates.extend((index, ) + index.get_key_names(self)
+                          for _, index in sorted(self._get_indexes().iteritems()))
+
+        plans = []
+        for index, hash_key, range_key in candidates:
+            key_conditions = {}
+            query_filter = {}
+            for field, op, field_and_op, value in conditions:
+                if field == hash_key and op == 'eq' and hash_key not in key_conditions:
+                    key_conditions[hash_key] = (field_and_op, value)
+                elif (field == range_key and op in _KEY_OPERATORS
+                      and range_key not in key_conditions):
+                    key_conditions[range_key] = (field_and_op, value)
+                else:
+                    query_filter[field_and_op] = value
+            if hash_key not in key_conditions:
+                continue
+
+            cost = 10 * len(query_filter)
+            if range_key in key_conditions:
+                # A range condition narrows what DynamoDB has to read.
+                cost -= 1
+
+            if index is None:
+                cost += Index.projection_costs[Index.ALL]
+            else:
+                needed = attributes
+                if needed is not None:
+                    needed = set(needed)
+                    needed.update(field for field, _, field_and_op, _ in conditions
+                                  if field_and_op in query_filter)
+                cost += Index.projection_costs[index.projection_type]
+                if not index.projects(self, needed):
+                    if index.kind == 'global':
+                        # Global indexes can't fetch what they don't project.
+                        continue
+                    cost += Index.fetch_cost
+
+            plans.append(QueryPlan(
+                index = index.name if index is not None else None,
+                key_conditions = dict(key_conditions.itervalues()),
+                query_filter = query_filter,
+                cost = cost,
+                ))
+
+        if not plans:
+            raise ValueError("No index on '%s' can serve a query on %s." % (
+                self.table_name, ', '.join(sorted(filter_kwargs))))
+
+        # The table itself comes first, so it wins any tie.
+        return min(plans, key=lambda plan: plan.cost)
+
+    @_traced('query')
     def query(self, limit=None, index=None, reverse=False, consistent=False, attributes=None,
-                max_page_size=None, query_filter=None, conditional_operator=None, **filter_kwargs):
+                max_page_size=None, query_filter=None, conditional_operator=None, fields=None,
+                **filter_kwargs):
         """Perform a query on the table.
 
+        Pass `fields` (a list of `Field`s or attribute names) to fetch
+        only those attributes. The returned Items are partial: reading
+        any other field on one fetches the rest of it, along with the
+        rest of any other partial items from the same query.
+
+        If `index` isn't given and secondary indexes have been
+        declared, the index is chosen by `plan_query()`. Conditions
+        that the chosen index can't use as key conditions are moved
+        to the query filter, with a `QueryPlanWarning`.
+
         Returns items using the registered subclass, if one has been registered.
 
+        If the table has `partition_cache` on, queries on a hash key
+        with at most one range key condition are answered from it.
+
         See http://boto.readthedocs.org/en/latest/ref/dynamodb.html#boto.dynamodb.table.Table.query
         """
-        return self.table.query_2(
+        if (self.partition_cache and self.cache is not None and index is None and not consistent
+                and attributes is None and query_filter is None and fields is None):
+            split = self._range_conditions(filter_kwargs)
+            if split is not None:
+                results = self._query_partition(split[0], split[1], reverse, limit)
+                if results is not None:
+                    return results
+
+        return self._query(limit=limit, index=index, reverse=reverse, consistent=consistent,
+                           attributes=attributes, max_page_size=max_page_size, query_filter=query_filter,
+                           conditional_operator=conditional_operator, fields=fields, **filter_kwargs)
+
+    def _query(self, limit=None, index=None, reverse=False, consistent=False, attributes=None,
+               max_page_size=None, query_filter=None, conditional_operator=None, fields=None,
+               **filter_kwargs):
+        if fields is not None:
+            attributes = self._get_field_names(fields)
+
+        if index is None and filter_kwargs and self._get_indexes():
+            plan = self.plan_query(attributes=attributes, **filter_kwargs)
+            index = plan.index
+            filter_kwargs = plan.key_conditions
+            if plan.query_filter:
+                if query_filter and conditional_operator == 'OR':
+                    raise ValueError("Can't combine %s with an OR query filter." % (
+                        ', '.join(sorted(plan.query_filter))))
+                warnings.warn("Query on '%s' (index %s) has to filter on %s." % (
+                    self.table_name, plan.index, ', '.join(sorted(plan.query_filter))),
+                    QueryPlanWarning)
+                query_filter = dict(query_filter or {}, **plan.query_filter)
+
+        # A local index shares the table's hash key, and so its shards.
+        if ((index is None or getattr(self._get_indexes().get(index), 'kind', None) == 'local')
+                and self._get_item_shards() and '%s__eq' % self.hash_key_name in filter_kwargs):
+            query = self._query_shards
+        elif self._get_item_shards():
+            query = lambda **kwargs: self._unshard_iter(self._lazy_results(self.table.query_2(**kwargs)))
+        else:
+            query = lambda **kwargs: self._lazy_results(self.table.query_2(**kwargs))
+
+        results = query(
             limit                 = limit,
             index                 = index,
             reverse               = reverse,
@@ -532,17 +2303,669 @@ class Table(object):
             conditional_operator  = conditional_operator,
             **filter_kwargs
           )
+        if fields is not None:
+            results = self._extend_partial(results, attributes)
+        return results
 
-    def scan(self, **kwargs):
+    def _lazy_results(self, results):
+        """Have a boto result set build lazily-decoded Items, if the Item class wants them.
+        """
+        item_class = Item._table_types[self.table_name]
+        if not item_class.lazy_decode:
+            return results
+
+        with _raw_item_connections_lock:
+            if not isinstance(self.table.connection, _RawItemConnection):
+                self.table.connection = _RawItemConnection(self.table.connection)
+        connection = self.table.connection
+        fetch_page = results.the_callable
+
+        def lazy_page(*args, **kwargs):
+            with connection.capture() as raw_items:
+                page = fetch_page(*args, **kwargs)
+            page['results'] = [self._extend(item_class(self.table, data=_LazyData(raw, self.table._dynamizer),
+                                                       loaded=True))
+                               for raw in raw_items]
+            return page
+
+        results.the_callable = lazy_page
+        return results
+
+    def _get_write_shards(self):
+        return self.write_shards or Item._table_types[self.table_name].write_shards
+
+    def _get_item_shards(self):
+        """Return the number of shards each hash key's items are spread over, if any.
+
+        On a hash-only table, write shards are only for `counter()`s;
+        its items are read and written as usual.
+        """
+        if self.range_key_name is None:
+            return None
+        return self._get_write_shards()
+
+    def _shard_for(self, range_key):
+        """Pick the shard for an item by its range key.
+        """
+        return zlib.crc32(unicode(range_key).encode('utf-8')) % self._get_write_shards()
+
+    def _shard_key(self, hash_key, shard):
+        if not isinstance(hash_key, basestring):
+            raise ValueError("Hash keys in '%s' have to be strings to be sharded, not %r." % (
+                self.table_name, hash_key))
+        return u'%s%s%d' % (hash_key, self.shard_separator, shard)
+
+    def _unshard(self, item):
+        """Restore an item's hash key to the one it had before sharding.
+
+        Items written before sharding was turned on are left alone.
+        """
+        sharded = item[self.hash_key_name]
+        if self._get_item_shards() and isinstance(sharded, basestring):
+            hash_key, separator, shard = sharded.rpartition(self.shard_separator)
+            if not separator or not shard.isdigit():
+                return item
+            item._data[self.hash_key_name] = hash_key
+            if self.hash_key_name in item._orig_data:
+                item._orig_data[self.hash_key_name] = hash_key
+        return item
+
+    def _unshard_iter(self, items):
+        for item in items:
+            yield self._unshard(item)
+
+    def _batch_get(self, keys, **kwargs):
+        """Fetch items in batches by `(hash_key, )` or `(hash_key, range_key)` tuples.
+        """
+        shards = self._get_item_shards()
+        if shards:
+            keys = [(self._shard_key(key[0], self._shard_for(key[1])), ) + tuple(key[1:]) for key in keys]
+        key_names = [self.hash_key_name, self.range_key_name]
+        keys = [dict(zip(key_names, key)) for key in keys]
+        if self.hedge_after is not None:
+            results = self._hedged(lambda: list(self._lazy_results(self.table.batch_get(keys=keys, **kwargs))))
+        else:
+            results = self._lazy_results(self.table.batch_get(keys=keys, **kwargs))
+        return self._unshard_iter(results) if shards else results
+
+    def _get_latencies(self):
+        if self.table_name not in self._latencies:
+            self._latencies[self.table_name] = _LatencyTracker()
+        return self._latencies[self.table_name]
+
+    def _hedged(self, call, *args, **kwargs):
+        """Make a read, hedging it according to `hedge_after` and `hedge_budget`.
+        """
+        latencies = self._get_latencies()
+        if self.hedge_after == 'p95':
+            delay = latencies.percentile(95)
+        else:
+            delay = self.hedge_after
+        latencies.requests += 1
+        if delay is None:
+            # Still warming up: time the read, so that there will be a percentile.
+            started = time.time()
+            result = call(*args, **kwargs)
+            latencies.add(time.time() - started)
+            return result
+
+        answers = Queue.Queue()
+
+        def attempt(hedge):
+            started = time.time()
+            try:
+                answers.put((hedge, True, call(*args, **kwargs)))
+            except Exception as e:
+                answers.put((hedge, False, e))
+            latencies.add(time.time() - started)
+        attempt = self.duo_db._carry_capacity_tag(attempt)
+
+        def start(hedge):
+            thread = threading.Thread(target=attempt, args=(hedge, ))
+            thread.daemon = True
+            thread.start()
+
+        start(False)
+        outstanding = 1
+        try:
+            answer = answers.get(timeout=delay)
+        except Queue.Empty:
+            if latencies.hedges < self.hedge_budget * latencies.requests:
+                latencies.hedges += 1
+                self.duo_db.stats['hedged_reads'] += 1
+                start(True)
+                outstanding += 1
+            answer = answers.get()
+        outstanding -= 1
+
+        hedge, succeeded, result = answer
+        if not succeeded and outstanding:
+            # Give the other one a chance.
+            hedge, succeeded, result = answers.get()
+        if hedge and succeeded:
+            self.duo_db.stats['hedge_wins'] += 1
+        if not succeeded:
+            raise result
+        return result
+
+    def _query_shards(self, limit=None, reverse=False, index=None, **kwargs):
+        """Query every shard of a hash key in parallel, and merge the results by range key.
+
+        `index` may be the name of a local index, whose range key they're merged by instead.
+        """
+        condition = '%s__eq' % self.hash_key_name
+        hash_key = kwargs.pop(condition)
+        range_key_name = self.range_key_name if index is None else self._get_indexes()[index].range_key
+
+        def query_shard(shard):
+            shard_kwargs = dict(kwargs)
+            shard_kwargs[condition] = self._shard_key(hash_key, shard)
+            return list(self._lazy_results(self.table.query_2(
+                limit=limit, index=index, reverse=reverse, **shard_kwargs)))
+
+        shards = range(self._get_item_shards())
+        results = [self._unshard(item)
+                   for items in _get_thread_pool(self.shard_concurrency).map(
+                       self.duo_db._carry_capacity_tag(query_shard), shards)
+                   for item in items]
+        results.sort(key=lambda item: item[range_key_name], reverse=reverse)
+        return results[:limit] if limit else results
+
+    def counter(self, hash_key, attribute='count'):
+        """Return a `ShardedCounter` for the given key of a sharded, hash-only table.
+        """
+        return ShardedCounter(self, hash_key, attribute)
+
+    @_traced('scan')
+    def scan(self, fields=None, **kwargs):
         """Scan through this table.
 
         This is a very long and expensive operation, and should be avoided if at all possible.
 
+        Pass `fields` to fetch partial Items, as with `query()`.
+
         Returns items using the registered subclass, if one has been registered.
 
         See http://boto.readthedocs.org/en/latest/ref/dynamodb.html#boto.dynamodb.table.Table.scan
         """
-        return self.table.scan(**kwargs)
+        if fields is not None:
+            kwargs['attributes'] = self._get_field_names(fields)
+        results = self._lazy_results(self.table.scan(**kwargs))
+        if self._get_item_shards():
+            results = self._unshard_iter(results)
+        if fields is not None:
+            results = self._extend_partial(results, kwargs['attributes'])
+        return results
+
+    # Each eventually-consistent read of an item up to 4KB costs half a
+    # read capacity unit.
+    _read_units_per_item = 0.5
+
+    def _get_read_capacity(self):
+        """Look up the table's provisioned read capacity.
+        """
+        description = self.table.describe()
+        return description['Table']['ProvisionedThroughput']['ReadCapacityUnits']
+
+    def _parse_key(self, parts):
+        """Convert a key given as text, `(hash_key[, range_key])`, to the types in the table's schema.
+
+        Numbers become Decimals, and binary values are read as base64.
+        """
+        if not self.table.schema:
+            self.table.describe()
+        data_types = dict((field.name, field.data_type) for field in self.table.schema)
+        key = []
+        for name, part in zip((self.hash_key_name, self.range_key_name), parts):
+            data_type = data_types.get(name)
+            if data_type == 'N':
+                part = Decimal(part)
+            elif data_type == 'B':
+                part = _boto.Binary(base64.b64decode(part))
+            key.append(part)
+        return tuple(key)
+
+    def _set_cache_multi(self, items):
+        """Store a batch of items in the cache, with one `set_multi()` if the cache has it.
+        """
+        item_class = Item._table_types[self.table_name]
+        items = [self._extend(item_class(self.table, data=item, loaded=True)) for item in items]
+        mapping = dict((item._cache_key, item._cache_payload()) for item in items)
+        if hasattr(self.cache, 'set_multi'):
+            self.cache.set_multi(mapping, item_class.cache_duration)
+        else:
+            for key, value in mapping.iteritems():
+                self.cache.set(key, value, item_class.cache_duration)
+        return len(mapping)
+
+    def warm_cache(self, keys=None, query=None, scan=None, concurrency=4, capacity_share=0.5,
+                   read_capacity=None, progress=None):
+        """Load items in bulk into the cache, e.g. after a deploy or a cache restart.
+
+        Warms either the given `keys` (hash keys, or `(hash_key,
+        range_key)` tuples), the results of `query` (a dict of
+        `query()` arguments), or a parallel scan in `concurrency`
+        segments filtered by `scan` (a dict of scan filter arguments;
+        `{}` for the whole table).
+
+        Reads are limited to `capacity_share` of the table's provisioned
+        read capacity (`read_capacity`, looked up if not given; pass
+        `capacity_share=None` for no limit). `progress`, if given, is
+        called with the running report after every batch.
+
+        Returns a report dict: `requested`, `cached` (already in the
+        cache), `loaded`, `missing`, `elapsed` and `hit_rate`, the share
+        of requested items now in the cache.
+        """
+        if self.cache is None or Item._table_types[self.table_name].cache_duration is None:
+            raise ValueError("Caching isn't enabled for '%s'." % self.table_name)
+        if capacity_share is not None and read_capacity is None:
+            read_capacity = self._get_read_capacity()
+        limiter = _RateLimiter(capacity_share and read_capacity * capacity_share)
+
+        report = dict(requested=0, cached=0, loaded=0, missing=0, elapsed=0.0, hit_rate=0.0)
+        lock = threading.Lock()
+        started = time.time()
+
+        def update(**counts):
+            with lock:
+                for name, count in counts.iteritems():
+                    report[name] += count
+                report['elapsed'] = time.time() - started
+                if report['requested']:
+                    report['hit_rate'] = float(report['cached'] + report['loaded']) / report['requested']
+                if progress is not None:
+                    progress(dict(report))
+
+        def warm_items(items):
+            # Items from a query or scan: one rate-limited, multi-set page at a time.
+            for chunk in _chunks(items, 100):
+                limiter.acquire(len(chunk) * self._read_units_per_item)
+                update(requested=len(chunk), loaded=self._set_cache_multi(chunk))
+
+        def warm_keys(chunk):
+            limiter.acquire(len(chunk) * self._read_units_per_item)
+            items = list(self._batch_get(chunk))
+            loaded = self._set_cache_multi(items) if items else 0
+            update(requested=len(chunk), loaded=loaded, missing=len(chunk) - loaded)
+
+        def warm_segment(segment):
+            warm_items(self.scan(segment=segment, total_segments=concurrency, **scan))
+
+        warm_keys = self.duo_db._carry_capacity_tag(warm_keys)
+        warm_segment = self.duo_db._carry_capacity_tag(warm_segment)
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(concurrency)
+        try:
+            if keys is not None:
+                keys = [key if isinstance(key, tuple) else (key, ) for key in keys]
+                for chunk in _chunks(keys, 100):
+                    # Skip anything that's already cached.
+                    cache_keys = [self._make_cache_key(key[0], key[1] if len(key) > 1 else None)
+                                  for key in chunk]
+                    if hasattr(self.cache, 'get_multi'):
+                        found = self.cache.get_multi(cache_keys)
+                    else:
+                        found = dict((k, v) for k, v in ((k, self.cache.get(k)) for k in cache_keys)
+                                     if v is not None)
+                    uncached = [key for key, cache_key in zip(chunk, cache_keys) if cache_key not in found]
+                    update(requested=len(chunk) - len(uncached), cached=len(chunk) - len(uncached))
+                    pool.map(warm_keys, list(_chunks(uncached, 100 // concurrency or 1)))
+            elif query is not None:
+                warm_items(self.query(**query))
+            elif scan is not None:
+                pool.map(warm_segment, range(concurrency))
+            else:
+                raise ValueError('Specify keys, a query or a scan to warm the cache with.')
+        finally:
+            pool.close()
+            pool.join()
+
+        update()
+        return report
+
+
+    # Each write of an item up to 1KB, deletes included, costs one
+    # write capacity unit.
+    _write_units_per_item = 1
+
+    def _get_write_capacity(self):
+        """Look up the table's provisioned write capacity.
+        """
+        description = self.table.describe()
+        return description['Table']['ProvisionedThroughput']['WriteCapacityUnits']
+
+    def _delete_keys(self, keys):
+        """Delete items by `(hash_key, range_key)` in one batched write, and drop them from the cache.
+        """
+        if self.table_name in self.duo_db._write_behind:
+            # Don't let a queued put bring one back.
+            queue = self.duo_db._write_behind[self.table_name]
+            for key in keys:
+                queue.discard(key)
+
+        sharded = self._get_item_shards()
+        with self.table.batch_write() as batch:
+            for hash_key, range_key in keys:
+                if sharded:
+                    hash_key = self._shard_key(hash_key, self._shard_for(range_key))
+                key = {self.hash_key_name: hash_key}
+                if self.range_key_name is not None:
+                    key[self.range_key_name] = range_key
+                batch.delete_item(**key)
+
+        if self.cache is not None:
+            cache_keys = [self._make_cache_key(hash_key, range_key) for hash_key, range_key in keys]
+            try:
+                if hasattr(self.cache, 'delete_multi'):
+                    self.cache.delete_multi(cache_keys)
+                else:
+                    for cache_key in cache_keys:
+                        self.cache.delete(cache_key)
+                self._drop_partitions(hash_key for hash_key, _ in keys)
+            except Exception as e:
+                warnings.warn('Cache invalidation failed on a bulk delete. %s: %s' % (
+                    e.__class__.__name__, e))
+        return len(keys)
+
+    def _bulk_delete(self, sources, concurrency, capacity_share, write_capacity):
+        """Delete the keys from each source in `sources`, a list of callables returning iterables.
+
+        Sources are run in parallel, and each one's keys deleted in
+        batches of 25 (the most DynamoDB takes at once), within
+        `capacity_share` of the table's write capacity. Returns the
+        number of items deleted.
+        """
+        if capacity_share is not None and write_capacity is None:
+            write_capacity = self._get_write_capacity()
+        limiter = _RateLimiter(capacity_share and write_capacity * capacity_share)
+
+        def delete_source(source):
+            deleted = 0
+            for chunk in _chunks(source(), 25):
+                limiter.acquire(len(chunk) * self._write_units_per_item)
+                deleted += self._delete_keys(chunk)
+            return deleted
+
+        if len(sources) == 1:
+            return delete_source(sources[0])
+        return sum(_get_thread_pool(concurrency).map(self.duo_db._carry_capacity_tag(delete_source), sources))
+
+    def _item_keys(self, items):
+        for item in items:
+            yield (item[self.hash_key_name],
+                   item[self.range_key_name] if self.range_key_name is not None else None)
+
+    def delete_many(self, keys, concurrency=4, capacity_share=0.5, write_capacity=None):
+        """Delete items by key (hash keys, or `(hash_key, range_key)` tuples), in parallel batches.
+
+        Cached copies are deleted too. Writes are limited to
+        `capacity_share` of the table's provisioned write capacity
+        (`write_capacity`, looked up if not given; pass
+        `capacity_share=None` for no limit). Returns the number of
+        items deleted.
+        """
+        keys = [key if isinstance(key, tuple) else (key, None) for key in keys]
+        sources = [(lambda chunk=chunk: chunk)
+                   for chunk in _chunks(keys, max(25, len(keys) // concurrency + 1))]
+        if not sources:
+            return 0
+        return self._bulk_delete(sources, concurrency, capacity_share, write_capacity)
+
+    def delete_where(self, query=None, scan=None, concurrency=4, capacity_share=0.5, write_capacity=None):
+        """Delete every item matching `query` (a dict of `query()` arguments) or `scan` (scan filters).
+
+        A scan runs in `concurrency` parallel segments. Only keys are
+        read; see `delete_many()` for the rest.
+        """
+        key_names = [name for name in (self.hash_key_name, self.range_key_name) if name is not None]
+        if query is not None:
+            sources = [lambda: self._item_keys(self.query(**dict(query, attributes=key_names)))]
+        elif scan is not None:
+            sources = [(lambda segment=segment: self._item_keys(self.scan(
+                segment=segment, total_segments=concurrency, attributes=key_names, **scan)))
+                for segment in range(concurrency)]
+        else:
+            raise ValueError('Specify a query or a scan to select the items to delete.')
+        return self._bulk_delete(sources, concurrency, capacity_share, write_capacity)
+
+    def truncate(self, segments=4, capacity_share=0.5, write_capacity=None):
+        """Delete every item in the table, scanning it in `segments` parallel segments.
+        """
+        return self.delete_where(scan={}, concurrency=segments, capacity_share=capacity_share,
+                                 write_capacity=write_capacity)
+
+    def map_reduce(self, map_fn, reduce_fn, segments=8, processes=None, default=None, **scan):
+        """Compute `map_fn(item)` for every item in the table, and combine the results with `reduce_fn`.
+
+        The table is scanned in `segments` segments, by a pool of
+        `processes` worker processes (by default, one per CPU), so
+        that decoding items and running `map_fn` use every core. Each
+        worker reduces the items of a segment to one value, which is
+        all that's sent back; the parent reduces those in turn. So
+        `reduce_fn(a, b)` has to be associative, and take the results
+        of `map_fn` as well as its own. Returns `default` if there are
+        no items. Extra keyword arguments are passed to `scan()`.
+
+        Workers are forked, so `map_fn` and `reduce_fn` can be any
+        callables, but the values they return have to pickle. Each
+        worker opens its own connections to DynamoDB.
+
+        Example::
+
+            total = DYNAMODB['orders'].map_reduce(lambda order: order['amount'], operator.add)
+        """
+        import multiprocessing
+
+        pool = multiprocessing.Pool(
+            processes or min(segments, multiprocessing.cpu_count()),
+            initializer = _map_reduce_init,
+            initargs = (self.duo_db, self.table_name, self.__class__, map_fn, reduce_fn, segments, scan,
+                        getattr(self.duo_db._capacity_tags, 'tag', None)))
+        try:
+            partials = pool.map(_map_reduce_segment, range(segments), chunksize=1)
+        except BaseException:
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+
+        db = self.duo_db
+        results = []
+        for found, result, stats, capacity in partials:
+            db.stats.update(stats)
+            with db._capacity_lock:
+                for key, units in capacity.iteritems():
+                    db._capacity[key] += units
+            if found:
+                results.append(result)
+        return reduce(reduce_fn, results) if results else default
+
+
+# What each `map_reduce()` worker process works on: (db, table, map_fn, reduce_fn, segments, scan).
+_map_reduce_state = None
+
+
+def _map_reduce_init(db, table_name, table_class, map_fn, reduce_fn, segments, scan, tag=None):
+    """Set up a freshly forked `map_reduce()` worker, with connections of its own.
+    """
+    global _map_reduce_state, _thread_pools_lock
+    from boto.connection import AWSAuthConnection, ConnectionPool
+
+    # Sockets, locks and threads inherited from the parent are no use here.
+    _thread_pools.clear()
+    _thread_pools_lock = threading.Lock()
+    db.__dict__.pop('_connection', None)
+    db._capacity_lock = threading.Lock()
+    db._write_behind = {}
+    db._write_behind_lock = threading.Lock()
+    db.recorder = None
+    db._capacity_tags = threading.local()
+    db._capacity_tags.tag = tag
+    for boto_table in db._tables.values():
+        connection = boto_table.connection
+        while isinstance(connection, (_CapacityConnection, _RawItemConnection)):
+            connection = connection.connection
+        if isinstance(connection, AWSAuthConnection):
+            connection._pool = ConnectionPool()
+
+    _map_reduce_state = (db, db[table_name, table_class], map_fn, reduce_fn, segments, scan)
+
+
+def _map_reduce_segment(segment):
+    """Reduce one segment of a `map_reduce()` scan, in a worker.
+
+    Returns `(found, result, stats, capacity)`, where `found` is
+    false if the segment had no items.
+    """
+    db, table, map_fn, reduce_fn, segments, scan = _map_reduce_state
+    db.stats.clear()
+    db._capacity.clear()
+    item_class = Item._table_types[table.table_name]
+
+    found, result = False, None
+    for item in table.scan(segment=segment, total_segments=segments, **scan):
+        if not isinstance(item, Item):
+            item = table._extend(item_class(table.table, data=item, loaded=True))
+        value = map_fn(item)
+        result = reduce_fn(result, value) if found else value
+        found = True
+    db.flush()
+    return found, result, dict(db.stats), dict(db._capacity)
+
+
+class ShardedCounter(object):
+    """A counter for a hash key that takes more increments than one partition can.
+
+    Each increment goes to one of the table's `write_shards` at
+    random; reading the value adds them all up.
+
+    Example::
+
+        class PageViews(duo.Table):
+            table_name = 'page_views'
+            hash_key_name = 'page'
+            write_shards = 10
+
+        views = DYNAMODB['page_views'].counter('/index.html')
+        views.incr()
+        views.value
+    """
+    def __init__(self, table, hash_key, attribute='count'):
+        if not table._get_write_shards() or table.range_key_name is not None:
+            raise ValueError("Counters need a hash-only table with write_shards; '%s' isn't one." % (
+                table.table_name))
+        self.table = table
+        self.hash_key = hash_key
+        self.attribute = attribute
+        super(ShardedCounter, self).__init__()
+
+    def _get_keys(self):
+        table = self.table
+        return [{table.hash_key_name: table._shard_key(self.hash_key, shard)}
+                for shard in range(table._get_write_shards())]
+
+    def incr(self, amount=1):
+        """Add `amount` to the counter.
+        """
+        table = self.table
+        table.table.connection.update_item(
+            table.table_name,
+            table.table._encode_keys(random.choice(self._get_keys())),
+            attribute_updates = {
+                self.attribute: {'Action': 'ADD', 'Value': {'N': str(amount)}},
+                },
+            )
+
+    @property
+    def value(self):
+        """The current total, across all shards.
+        """
+        results = self.table.table.batch_get(keys=self._get_keys(), attributes=[self.attribute])
+        return sum(item.get(self.attribute, 0) or 0 for item in results)
+
+
+class KeyFilter(object):
+    """A Bloom filter of table keys, for skipping reads of keys that don't exist.
+
+    Keys are `(hash_key, range_key)` tuples, with `range_key=None` on a
+    hash-only table. A key that was added is always found; a key that
+    wasn't is wrongly found about `false_positive_rate` of the time.
+    Keys can't be removed, so deleted keys linger until a rebuild.
+    """
+    # num_bits, num_hashes, count, built, position.
+    _header = struct.Struct('!QIQdQ')
+
+    # Set bits in each possible byte.
+    _popcount = [bin(i).count('1') for i in range(256)]
+
+    def __init__(self, num_bits, num_hashes, bits=None, count=0, built=None, position=0):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+        self.count = count
+        self.built = built if built is not None else time.time()
+        # Where the table's log of put keys was when the build started.
+        self.position = position
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.01):
+        """Return an empty filter sized for `capacity` keys at `error_rate` false positives.
+        """
+        num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        num_hashes = max(1, int(round(float(num_bits) / capacity * math.log(2))))
+        return cls(num_bits, num_hashes)
+
+    @staticmethod
+    def _encode(key):
+        parts = []
+        for part in key:
+            if part is None:
+                continue
+            elif isinstance(part, unicode):
+                part = part.encode('utf-8')
+            elif isinstance(part, (int, long, Decimal)):
+                # So that 5, 5L and DynamoDB's Decimal('5') are the same key.
+                part = str(Decimal(part).normalize())
+            parts.append(str(part))
+        return '\x00'.join(parts)
+
+    def _positions(self, key):
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(self._encode(key)).digest())
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            for position in positions:
+                self.bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def false_positive_rate(self):
+        """The estimated chance that a key that was never added is found, given how full the filter is.
+        """
+        filled = sum(self._popcount[byte] for byte in self.bits)
+        return (float(filled) / self.num_bits) ** self.num_hashes
+
+    def dumps(self):
+        return self._header.pack(self.num_bits, self.num_hashes, self.count, self.built, self.position) + zlib.compress(
+            bytes(self.bits))
+
+    @classmethod
+    def loads(cls, value):
+        num_bits, num_hashes, count, built, position = cls._header.unpack_from(value)
+        bits = bytearray(zlib.decompress(value[cls._header.size:]))
+        return cls(num_bits, num_hashes, bits, count, built, position)
 
 
 class NONE(object): pass
@@ -565,6 +2988,10 @@ class Field(object):
         raise NotImplementedError()
 
     def __get__(self, obj, type=None):
+        if obj is None:
+            return self
+        if obj._projected is not None and self.name not in obj._projected:
+            obj._load_missing()
         try:
             value = self.to_python(obj, obj[self.name])
         except KeyError:
@@ -694,6 +3121,54 @@ class DateTimeField(Field):
             raise ValueError('DateTimeField requires a `datetime.datetime` object.')
 
 
+class CompressedTextField(Field):
+    """Store a unicode string, zlib-compressed as DynamoDB binary if it's longer than `compress_threshold` bytes.
+
+    Shorter values are stored as plain strings. The value is
+    decompressed the first time it's read, and reused after that.
+    """
+    def __init__(self, compress_threshold=1024, compress_level=6, **kwargs):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        super(CompressedTextField, self).__init__(**kwargs)
+
+    def to_python(self, obj, value):
+        # Remember what we decoded, for as long as the stored value doesn't change.
+        decoded = obj.__dict__.setdefault('_decoded_fields', {})
+        if self.name in decoded and decoded[self.name][0] is value:
+            return decoded[self.name][1]
+        python_value = self.decode(obj, value)
+        decoded[self.name] = (value, python_value)
+        return python_value
+
+    def decode(self, obj, value):
+        if isinstance(value, _boto.Binary):
+            return zlib.decompress(value.value).decode('utf-8')
+        return value
+
+    def from_python(self, obj, value):
+        value = unicode(value)
+        encoded = value.encode('utf-8')
+        if len(encoded) > self.compress_threshold:
+            return _boto.Binary(zlib.compress(encoded, self.compress_level))
+        return value
+
+
+class CompressedJSONField(CompressedTextField):
+    """Store a JSON-serializable value as JSON, compressed like a `CompressedTextField`.
+
+    Changes made to a value in place aren't saved until it's assigned
+    back to the field.
+    """
+    def decode(self, obj, value):
+        if isinstance(value, (basestring, _boto.Binary)):
+            return json.loads(super(CompressedJSONField, self).decode(obj, value))
+        return value
+
+    def from_python(self, obj, value):
+        return super(CompressedJSONField, self).from_python(obj, json.dumps(value, separators=(',', ':')))
+
+
 class ForeignKeyField(Field):
     """A unicode field that stores foreign DynamoDB table references as a JSON-serialized string.
     """
@@ -717,3 +3192,999 @@ class ForeignKeyField(Field):
             'table': value.table_name,
             'key': value.dynamo_key
             })
+
+
+# Reference data that every request reads, and that changes daily, is
+# better read from a local file than from the network. A snapshot
+# holds a table's items, encoded as DynamoDB sends them, sorted by
+# hash key and then range key, with a fixed-size index for binary
+# searching.
+
+
+class _Snapshot(object):
+    """A snapshot file written by `Table.snapshot()`, memory-mapped for reading.
+    """
+    magic = 'duosnap1'
+    # Magic, item count, index offset, creation time.
+    header = struct.Struct('!8sQQd')
+    # Key offset, hash key length, range key length, item offset, item length.
+    entry = struct.Struct('!QIIQI')
+
+    def __init__(self, path):
+        import mmap
+
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = (stat.st_ino, stat.st_mtime)
+        magic, self.count, self.index_offset, self.created = self.header.unpack_from(self.map)
+        if magic != self.magic:
+            raise ValueError("'%s' isn't a duo snapshot." % path)
+
+    @staticmethod
+    def _encode_range(range_key):
+        if range_key is None:
+            return ''
+        elif isinstance(range_key, (int, long, float, Decimal)):
+            return 'n' + str(range_key)
+        elif isinstance(range_key, _boto.Binary):
+            return 'b' + range_key.value
+        elif isinstance(range_key, str):
+            return 's' + range_key
+        return 's' + unicode(range_key).encode('utf-8')
+
+    @staticmethod
+    def _decode_range(encoded):
+        if not encoded:
+            return None
+        tag, value = encoded[0], encoded[1:]
+        if tag == 'n':
+            return Decimal(value)
+        elif tag == 'b':
+            return value
+        return value.decode('utf-8')
+
+    @classmethod
+    def _range_value(cls, range_key):
+        """Convert a range key to what it's compared with in the snapshot.
+        """
+        return cls._decode_range(cls._encode_range(range_key))
+
+    @classmethod
+    def write(cls, path, records):
+        """Write `(hash_key, range_key, encoded item)` records to a new snapshot at `path`.
+        """
+        records = sorted(
+            (KeyFilter._encode((hash_key, )), cls._range_value(range_key), cls._encode_range(range_key),
+             marshal.dumps(item, 2))
+            for hash_key, range_key, item in records)
+
+        temp = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp, 'wb') as f:
+            f.write('\0' * cls.header.size)
+            offset = cls.header.size
+            item_offsets = []
+            for _, _, _, item in records:
+                f.write(item)
+                item_offsets.append(offset)
+                offset += len(item)
+            key_offsets = []
+            for hash_key, _, range_key, _ in records:
+                f.write(hash_key + range_key)
+                key_offsets.append(offset)
+                offset += len(hash_key) + len(range_key)
+            for (hash_key, _, range_key, item), key_offset, item_offset in zip(
+                    records, key_offsets, item_offsets):
+                f.write(cls.entry.pack(key_offset, len(hash_key), len(range_key), item_offset, len(item)))
+            f.seek(0)
+            f.write(cls.header.pack(cls.magic, len(records), offset, time.time()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp, path)
+
+    def _entry(self, index):
+        return self.entry.unpack_from(self.map, self.index_offset + index * self.entry.size)
+
+    def _hash_key(self, index):
+        key_offset, hash_length, _, _, _ = self._entry(index)
+        return self.map[key_offset:key_offset + hash_length]
+
+    def _range_key(self, index):
+        key_offset, hash_length, range_length, _, _ = self._entry(index)
+        start = key_offset + hash_length
+        return self._decode_range(self.map[start:start + range_length])
+
+    def item(self, index):
+        """Return the encoded item at `index`.
+        """
+        _, _, _, item_offset, item_length = self._entry(index)
+        return marshal.loads(self.map[item_offset:item_offset + item_length])
+
+    def _bisect(self, key, lo, hi, right=False):
+        while lo < hi:
+            middle = (lo + hi) // 2
+            found = key(middle)
+            if found[0] < found[1] or (right and found[0] == found[1]):
+                lo = middle + 1
+            else:
+                hi = middle
+        return lo
+
+    def find(self, hash_key, conditions=()):
+        """Return the range of indexes of items with `hash_key`, and range keys meeting `conditions`.
+
+        Conditions are `(operator, value)` pairs, on the range key.
+        """
+        encoded = KeyFilter._encode((hash_key, ))
+        hash_key = lambda index: (self._hash_key(index), encoded)
+        lo = self._bisect(hash_key, 0, self.count)
+        hi = self._bisect(hash_key, lo, self.count, right=True)
+
+        for operator, value in conditions:
+            if operator == 'between':
+                values = [self._range_value(v) for v in value]
+            else:
+                values = [self._range_value(value)]
+            range_key = lambda index: (self._range_key(index), values[0])
+            if operator in ('eq', 'gte', 'between', 'beginswith'):
+                lo = max(lo, self._bisect(range_key, lo, hi))
+            if operator in ('eq', 'lte'):
+                hi = min(hi, self._bisect(range_key, lo, hi, right=True))
+            elif operator == 'gt':
+                lo = max(lo, self._bisect(range_key, lo, hi, right=True))
+            elif operator == 'lt':
+                hi = min(hi, self._bisect(range_key, lo, hi))
+            elif operator == 'between':
+                range_key = lambda index: (self._range_key(index), values[1])
+                hi = min(hi, self._bisect(range_key, lo, hi, right=True))
+            elif operator == 'beginswith':
+                end = lo
+                while end < hi and self._range_key(end).startswith(values[0]):
+                    end += 1
+                hi = end
+        return lo, max(lo, hi)
+
+
+class SnapshotTable(Table):
+    """A Table read from a local snapshot file, with no network requests.
+
+    For reference data that is read all the time and changes rarely:
+    write the snapshot with `Table.snapshot(path)` (or `duo snapshot
+    <table> <path>`), say daily, and point `snapshot_path` at it.
+    `Table[key]`, `.get_item()`, and queries on a hash key with at most
+    one range key condition are then served from the snapshot.
+    Consistent reads, other queries and all writes go to DynamoDB, and
+    writes only show up in the next snapshot. Without a snapshot file,
+    everything goes to DynamoDB.
+
+    Each process checks for a new snapshot every
+    `snapshot_check_interval` seconds, and switches to it; reads in
+    progress finish with the old one.
+    """
+    snapshot_path = None
+    snapshot_check_interval = 10
+
+    # Snapshots open in this process, by path: (snapshot, next check).
+    _snapshots = {}
+
+    def get_snapshot(self):
+        """Return the current snapshot, or `None` if there isn't one.
+        """
+        if self.snapshot_path is None:
+            return None
+        now = time.time()
+        snapshot, check_at = self._snapshots.get(self.snapshot_path, (None, 0))
+        if now >= check_at:
+            try:
+                stat = os.stat(self.snapshot_path)
+            except OSError:
+                snapshot = None
+            else:
+                if snapshot is None or snapshot.identity != (stat.st_ino, stat.st_mtime):
+                    snapshot = _Snapshot(self.snapshot_path)
+            self._snapshots[self.snapshot_path] = (snapshot, now + self.snapshot_check_interval)
+        return snapshot
+
+    def _snapshot_items(self, snapshot, lo, hi, reverse=False, limit=None):
+        item_class = Item._table_types[self.table_name]
+        indexes = xrange(hi - 1, lo - 1, -1) if reverse else xrange(lo, hi)
+        for index in itertools.islice(indexes, limit):
+            item = self._extend(item_class(self.table))
+            item.load({'Item': snapshot.item(index)})
+            yield item
+
+    @_traced('get_item')
+    def get_item(self, hash_key, range_key=None, consistent=False, **params):
+        snapshot = self.get_snapshot()
+        if snapshot is None or consistent:
+            return super(SnapshotTable, self).get_item(hash_key, range_key, consistent=consistent, **params)
+
+        conditions = [('eq', range_key)] if range_key is not None else []
+        lo, hi = snapshot.find(hash_key, conditions)
+        for item in self._snapshot_items(snapshot, lo, min(hi, lo + 1)):
+            return item
+        raise _boto.ItemNotFound("Item (%s, %s) couldn't be found." % (hash_key, range_key))
+
+    @_traced('get')
+    def __getitem__(self, key):
+        if self.get_snapshot() is None:
+            return super(SnapshotTable, self).__getitem__(key)
+
+        if isinstance(key, tuple):
+            hash_key, range_key = key
+        else:
+            hash_key, range_key = key, None
+        if range_key is None and self.range_key_name is not None:
+            return self.query(**{'%s__eq' % self.hash_key_name: hash_key})
+        try:
+            return self.get_item(hash_key, range_key)
+        except ItemNotFound:
+            return self.create(hash_key, range_key)
+
+    @_traced('query')
+    def query(self, limit=None, index=None, reverse=False, consistent=False, **filter_kwargs):
+        snapshot = self.get_snapshot()
+        split = self._range_conditions(filter_kwargs)
+        if snapshot is None or index is not None or consistent or split is None:
+            return super(SnapshotTable, self).query(limit=limit, index=index, reverse=reverse,
+                                                    consistent=consistent, **filter_kwargs)
+
+        lo, hi = snapshot.find(*split)
+        return list(self._snapshot_items(snapshot, lo, hi, reverse, limit))
+
+
+# Cache backends, for when memcached alone isn't enough. Any of these
+# can be passed as a DynamoDB's or a Table's `cache`: they all speak
+# the subset of the memcached client interface duo uses.
+
+
+class _Cache(object):
+    """The multi-key methods of a cache, made of its single-key ones.
+    """
+    def get_multi(self, keys):
+        found = ((key, self.get(key)) for key in keys)
+        return dict((key, value) for key, value in found if value is not None)
+
+    def set_multi(self, mapping, duration=0):
+        for key, value in mapping.iteritems():
+            self.set(key, value, duration)
+        return []
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.delete(key)
+        return True
+
+
+class LocalCache(_Cache):
+    """A cache in this process's memory, expiring values as memcached would.
+
+    Holds at most `max_items` values, if given, dropping the oldest.
+    """
+    def __init__(self, max_items=None):
+        self.max_items = max_items
+        self.values = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _store(self, key, value, duration):
+        self.values.pop(key, None)
+        self.values[key] = (copy.deepcopy(value), duration and time.time() + duration)
+        if self.max_items is not None:
+            while len(self.values) > self.max_items:
+                self.values.popitem(last=False)
+
+    def get(self, key):
+        with self.lock:
+            value, expires = self.values.get(key, (None, None))
+            if expires and expires < time.time():
+                del self.values[key]
+                return None
+            return copy.deepcopy(value)
+
+    def set(self, key, value, duration=0):
+        with self.lock:
+            self._store(key, value, duration)
+        return True
+
+    def add(self, key, value, duration=0):
+        with self.lock:
+            if key in self.values and not (self.values[key][1] and self.values[key][1] < time.time()):
+                return False
+            self._store(key, value, duration)
+        return True
+
+    def delete(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+        return True
+
+    def incr(self, key, delta=1):
+        with self.lock:
+            if key not in self.values:
+                return None
+            value, expires = self.values[key]
+            self.values[key] = (value + delta, expires)
+            return value + delta
+
+    def ttl(self, key):
+        """Return the seconds left before `key` expires, 0 if it never does, or `None` if it's missing.
+        """
+        with self.lock:
+            _, expires = self.values.get(key, (None, None))
+        if expires is None:
+            return None
+        return expires and max(expires - time.time(), 0)
+
+
+class SharedMemoryCache(_Cache):
+    """A cache shared by every process on the host, in a memory-mapped file.
+
+    The file (put it on a RAM disk, e.g. under /dev/shm) holds `size`
+    bytes of fixed-size slots, in groups of `ways`; each key can only
+    live in one group, and a new value replaces the key's old one, an
+    empty or expired slot, or else the slot that expires soonest.
+    Values are pickled, and any that don't fit in a slot, less a small
+    header, aren't kept. Processes lock just the group they use.
+
+    Every process must open the file with the same `size`, `slot_size`
+    and `ways`.
+    """
+    magic = 'duoshm01'
+    header = struct.Struct('!8sIII')
+    # Key digest, expiry time (0 for never), value length (0 for an empty slot).
+    slot_header = struct.Struct('!16sdI')
+
+    def __init__(self, path, size=64 * 1024 * 1024, slot_size=4096, ways=8):
+        import fcntl
+        import mmap
+
+        self.path = path
+        self.slot_size = slot_size
+        self.ways = ways
+        self.groups = max(1, (size - self.slot_size) // (slot_size * ways))
+        self.lock = threading.Lock()
+        self._fcntl = fcntl
+
+        length = self.slot_size + self.groups * ways * slot_size
+        header = self.header.pack(self.magic, slot_size, ways, self.groups)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size == 0:
+                # We're first: set it up.
+                os.ftruncate(self.fd, length)
+                os.write(self.fd, header)
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            usable = os.fstat(self.fd).st_size == length and os.read(self.fd, self.header.size) == header
+            if usable:
+                self.map = mmap.mmap(self.fd, length)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        if not usable:
+            os.close(self.fd)
+            raise ValueError("'%s' was set up for a different cache size, slot size or ways." % path)
+
+    @contextlib.contextmanager
+    def _locked(self, group, exclusive):
+        """Lock a group of slots against other threads and processes.
+        """
+        start = self.slot_size + group * self.ways * self.slot_size
+        length = self.ways * self.slot_size
+        with self.lock:
+            self._fcntl.lockf(self.fd, self._fcntl.LOCK_EX if exclusive else self._fcntl.LOCK_SH,
+                              length, start)
+            try:
+                yield start
+            finally:
+                self._fcntl.lockf(self.fd, self._fcntl.LOCK_UN, length, start)
+
+    def _find(self, start, digest):
+        """Return the offset of the slot holding `digest`, and its header, or `(None, None)`.
+        """
+        for offset in range(start, start + self.ways * self.slot_size, self.slot_size):
+            header = self.slot_header.unpack_from(self.map, offset)
+            if header[0] == digest and header[2]:
+                return offset, header
+        return None, None
+
+    def _locate(self, key):
+        digest = hashlib.md5(key).digest()
+        return digest, struct.unpack_from('!Q', digest)[0] % self.groups
+
+    def get(self, key):
+        digest, group = self._locate(key)
+        with self._locked(group, exclusive=False) as start:
+            offset, header = self._find(start, digest)
+            if offset is None or (header[1] and header[1] < time.time()):
+                return None
+            start = offset + self.slot_header.size
+            value = self.map[start:start + header[2]]
+        return pickle.loads(value)
+
+    def _write(self, start, digest, value, duration):
+        """Store a pickled value in the group at `start`. Call with the group locked.
+        """
+        now = time.time()
+        offset, _ = self._find(start, digest)
+        if offset is None:
+            # An empty or expired slot, or else the one that expires soonest.
+            def expires(offset):
+                _, expires, length = self.slot_header.unpack_from(self.map, offset)
+                if not length or (expires and expires < now):
+                    return -1
+                return expires or float('inf')
+            offset = min(range(start, start + self.ways * self.slot_size, self.slot_size), key=expires)
+        self.map[offset:offset + self.slot_header.size] = self.slot_header.pack(
+            digest, duration and now + duration, len(value))
+        self.map[offset + self.slot_header.size:offset + self.slot_header.size + len(value)] = value
+
+    def set(self, key, value, duration=0):
+        value = pickle.dumps(value, 2)
+        if len(value) > self.slot_size - self.slot_header.size:
+            # Too big to keep here; don't leave an old value behind.
+            self.delete(key)
+            return False
+        digest, group = self._locate(key)
+        with self._locked(group, exclusive=True) as start:
+            self._write(start, digest, value, duration)
+        return True
+
+    def add(self, key, value, duration=0):
+        if self.get(key) is not None:
+            return False
+        return self.set(key, value, duration)
+
+    def delete(self, key):
+        digest, group = self._locate(key)
+        with self._locked(group, exclusive=True) as start:
+            offset, _ = self._find(start, digest)
+            if offset is not None:
+                self.map[offset:offset + self.slot_header.size] = self.slot_header.pack('\0' * 16, 0, 0)
+        return True
+
+    def incr(self, key, delta=1):
+        digest, group = self._locate(key)
+        with self._locked(group, exclusive=True) as start:
+            offset, header = self._find(start, digest)
+            if offset is None or (header[1] and header[1] < time.time()):
+                return None
+            value_start = offset + self.slot_header.size
+            value = pickle.loads(self.map[value_start:value_start + header[2]]) + delta
+            remaining = header[1] and max(header[1] - time.time(), 0.001)
+            self._write(start, digest, pickle.dumps(value, 2), remaining)
+        return value
+
+    def ttl(self, key):
+        """Return the seconds left before `key` expires, 0 if it never does, or `None` if it's missing.
+        """
+        digest, group = self._locate(key)
+        with self._locked(group, exclusive=False) as start:
+            offset, header = self._find(start, digest)
+        if offset is None:
+            return None
+        return header[1] and max(header[1] - time.time(), 0)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+class TieredCache(object):
+    """Looks values up in each of `tiers` in turn, and keeps them in all of them.
+
+    For example, a `LocalCache` for each process, a `SharedMemoryCache`
+    for the host, and memcached, so that a hot item is fetched from
+    memcached once per host rather than once per process. A value found
+    in a lower tier is copied into the tiers above it.
+
+    Only the last tier sees other hosts' writes, so the others keep
+    values for no more than `max_durations` (seconds per tier, `None`
+    for as long as asked; by default 10 seconds for all but the last).
+    `add()` and `incr()` are decided by the last tier.
+
+    A copied value doesn't outlive the one it was copied from, if that
+    tier can tell how long it has left (see `LocalCache.ttl()`); if it
+    can't, as memcached can't, it's kept for `promote_duration` seconds
+    at most.
+    """
+    def __init__(self, tiers, max_durations=None, promote_duration=10):
+        self.tiers = list(tiers)
+        if max_durations is None:
+            max_durations = [10] * (len(self.tiers) - 1) + [None]
+        self.max_durations = list(max_durations)
+        self.promote_duration = promote_duration
+        # Hits by tier number, and misses.
+        self.stats = collections.Counter()
+
+    def _duration(self, tier, duration):
+        limit = self.max_durations[tier]
+        if limit is None:
+            return duration
+        return min(duration, limit) if duration else limit
+
+    def _promote(self, tier, key, value):
+        """Copy a value found in `tier` into the tiers above it, for no longer than it has left.
+        """
+        remaining = None
+        if hasattr(self.tiers[tier], 'ttl'):
+            remaining = self.tiers[tier].ttl(key)
+        if remaining is None:
+            remaining = self.promote_duration
+        elif remaining:
+            # Whole seconds, as memcached wants them.
+            remaining = int(math.ceil(remaining))
+        for upper in range(tier):
+            self.tiers[upper].set(key, value, self._duration(upper, remaining))
+
+    def get(self, key):
+        for tier, cache in enumerate(self.tiers):
+            value = cache.get(key)
+            if value is not None:
+                self.stats[tier] += 1
+                self._promote(tier, key, value)
+                return value
+        self.stats['misses'] += 1
+        return None
+
+    def get_multi(self, keys):
+        found = {}
+        missing = list(keys)
+        for tier, cache in enumerate(self.tiers):
+            if not missing:
+                break
+            if hasattr(cache, 'get_multi'):
+                values = cache.get_multi(missing)
+            else:
+                values = dict((key, value) for key, value in ((key, cache.get(key)) for key in missing)
+                              if value is not None)
+            self.stats[tier] += len(values)
+            for key, value in values.iteritems():
+                self._promote(tier, key, value)
+            found.update(values)
+            missing = [key for key in missing if key not in values]
+        self.stats['misses'] += len(missing)
+        return found
+
+    def set(self, key, value, duration=0):
+        for tier, cache in enumerate(self.tiers):
+            cache.set(key, value, self._duration(tier, duration))
+        return True
+
+    def set_multi(self, mapping, duration=0):
+        for tier, cache in enumerate(self.tiers):
+            if hasattr(cache, 'set_multi'):
+                cache.set_multi(mapping, self._duration(tier, duration))
+            else:
+                for key, value in mapping.iteritems():
+                    cache.set(key, value, self._duration(tier, duration))
+        return []
+
+    def delete(self, key):
+        for cache in self.tiers:
+            cache.delete(key)
+        return True
+
+    def delete_multi(self, keys):
+        keys = list(keys)
+        for cache in self.tiers:
+            if hasattr(cache, 'delete_multi'):
+                cache.delete_multi(keys)
+            else:
+                for key in keys:
+                    cache.delete(key)
+        return True
+
+    def add(self, key, value, duration=0):
+        added = self.tiers[-1].add(key, value, duration)
+        # Either way, the upper tiers should learn the winning value from the last one.
+        for cache in self.tiers[:-1]:
+            cache.delete(key)
+        return added
+
+    def incr(self, key, delta=1):
+        value = self.tiers[-1].incr(key, delta)
+        for cache in self.tiers[:-1]:
+            cache.delete(key)
+        return value
+
+
+# Replaying a trace needs somewhere to replay it to. This stand-in
+# for DynamoDB keeps everything in memory, and only does as much as duo
+# needs of it. A `LocalCache` stands in for memcached.
+
+
+def _compare(operator, value, args):
+    if operator == 'NULL':
+        return value is None
+    elif operator == 'NOT_NULL':
+        return value is not None
+    elif operator == 'NE':
+        return value != args[0]
+    elif value is None:
+        return False
+    elif operator == 'EQ':
+        return value == args[0]
+    elif operator == 'LE':
+        return value <= args[0]
+    elif operator == 'LT':
+        return value < args[0]
+    elif operator == 'GE':
+        return value >= args[0]
+    elif operator == 'GT':
+        return value > args[0]
+    elif operator == 'BEGINS_WITH':
+        return value.startswith(args[0])
+    elif operator == 'BETWEEN':
+        return args[0] <= value <= args[1]
+    elif operator == 'IN':
+        return value in args
+    elif operator == 'CONTAINS':
+        return args[0] in value
+    elif operator == 'NOT_CONTAINS':
+        return args[0] not in value
+    raise ValueError('Unknown comparison operator %r.' % operator)
+
+
+class _LocalConnection(object):
+    """An in-memory stand-in for boto's DynamoDB connection, for replaying traces.
+
+    Tables need their key names in `schemas`. Each request takes
+    `latency` seconds. Capacity, conditional writes and paging aren't
+    simulated.
+    """
+    def __init__(self, schemas=None, latency=0.0):
+        self.schemas = dict(schemas or {})
+        self.latency = latency
+        self.tables = collections.defaultdict(dict)
+        self.dynamizer = _boto.Dynamizer()
+        self.lock = threading.Lock()
+
+    def _request(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _key(self, table_name, data):
+        return tuple(data[name].items()[0] for name in self.schemas[table_name] if name is not None)
+
+    def _matches(self, item, conditions):
+        for name, condition in (conditions or {}).iteritems():
+            value = self.dynamizer.decode(item[name]) if name in item else None
+            args = [self.dynamizer.decode(arg) for arg in condition.get('AttributeValueList', [])]
+            if not _compare(condition['ComparisonOperator'], value, args):
+                return False
+        return True
+
+    def _project(self, item, attributes):
+        if attributes is None:
+            return dict(item)
+        return dict((name, value) for name, value in item.iteritems() if name in attributes)
+
+    def describe_table(self, table_name):
+        self._request()
+        key_types = zip(self.schemas[table_name], ('HASH', 'RANGE'))
+        return {'Table': {
+            'TableName': table_name,
+            'ItemCount': len(self.tables[table_name]),
+            'KeySchema': [dict(AttributeName=name, KeyType=key_type)
+                          for name, key_type in key_types if name is not None],
+            'AttributeDefinitions': [dict(AttributeName=name, AttributeType='S')
+                                     for name, key_type in key_types if name is not None],
+            'ProvisionedThroughput': dict(ReadCapacityUnits=100000, WriteCapacityUnits=100000),
+            }}
+
+    def get_item(self, table_name, key, attributes_to_get=None, **kwargs):
+        self._request()
+        with self.lock:
+            item = self.tables[table_name].get(self._key(table_name, key))
+            return {'Item': self._project(item, attributes_to_get)} if item is not None else {}
+
+    def put_item(self, table_name, item, **kwargs):
+        self._request()
+        with self.lock:
+            self.tables[table_name][self._key(table_name, item)] = dict(item)
+        return {}
+
+    def update_item(self, table_name, key, attribute_updates, **kwargs):
+        self._request()
+        with self.lock:
+            item = self.tables[table_name].setdefault(self._key(table_name, key), dict(key))
+            for name, update in attribute_updates.iteritems():
+                action = update.get('Action', 'PUT')
+                if action == 'DELETE':
+                    item.pop(name, None)
+                elif action == 'ADD' and name in item:
+                    total = self.dynamizer.decode(item[name]) + self.dynamizer.decode(update['Value'])
+                    item[name] = self.dynamizer.encode(total)
+                else:
+                    item[name] = update['Value']
+        return {}
+
+    def delete_item(self, table_name, key, **kwargs):
+        self._request()
+        with self.lock:
+            self.tables[table_name].pop(self._key(table_name, key), None)
+        return {}
+
+    def batch_get_item(self, request_items, **kwargs):
+        self._request()
+        responses = {}
+        with self.lock:
+            for table_name, request in request_items.iteritems():
+                items = (self.tables[table_name].get(self._key(table_name, key)) for key in request['Keys'])
+                responses[table_name] = [self._project(item, request.get('AttributesToGet'))
+                                         for item in items if item is not None]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def batch_write_item(self, request_items, **kwargs):
+        self._request()
+        with self.lock:
+            for table_name, requests in request_items.iteritems():
+                for request in requests:
+                    if 'PutRequest' in request:
+                        item = request['PutRequest']['Item']
+                        self.tables[table_name][self._key(table_name, item)] = dict(item)
+                    else:
+                        self.tables[table_name].pop(self._key(table_name, request['DeleteRequest']['Key']), None)
+        return {'UnprocessedItems': {}}
+
+    def query(self, table_name, key_conditions=None, query_filter=None, limit=None, select=None,
+              scan_index_forward=True, attributes_to_get=None, **kwargs):
+        self._request()
+        with self.lock:
+            items = [item for item in self.tables[table_name].itervalues()
+                     if self._matches(item, key_conditions) and self._matches(item, query_filter)]
+        # Sort on the range key condition, if there is one.
+        for name, condition in (key_conditions or {}).iteritems():
+            if condition['ComparisonOperator'] != 'EQ' or name == self.schemas[table_name][1]:
+                items.sort(key=lambda item: self.dynamizer.decode(item[name]),
+                           reverse=not scan_index_forward)
+        items = items[:limit]
+        if select == 'COUNT':
+            return {'Count': len(items)}
+        return {'Items': [self._project(item, attributes_to_get) for item in items], 'Count': len(items)}
+
+    def scan(self, table_name, scan_filter=None, segment=None, total_segments=None, limit=None,
+             attributes_to_get=None, **kwargs):
+        self._request()
+        with self.lock:
+            items = [item for key, item in self.tables[table_name].iteritems()
+                     if (total_segments is None or hash(key) % total_segments == segment)
+                     and self._matches(item, scan_filter)]
+        items = items[:limit]
+        return {'Items': [self._project(item, attributes_to_get) for item in items], 'Count': len(items)}
+
+
+def _replay_entry(table, entry):
+    """Repeat one traced operation on `table`.
+    """
+    operation = entry['op']
+    key = entry.get('key') or [None]
+    hash_key, range_key = key[0], key[1] if len(key) > 1 else None
+    conditions = dict((str(name), value) for name, value in (entry.get('conditions') or {}).iteritems())
+
+    if operation == 'get':
+        result = table[(hash_key, range_key) if range_key is not None else hash_key]
+        if not isinstance(result, Item):
+            list(result)
+    elif operation == 'get_item':
+        try:
+            table.get_item(hash_key, range_key)
+        except ItemNotFound:
+            pass
+    elif operation == 'query':
+        list(table.query(limit=entry.get('limit'), index=entry.get('index'),
+                         reverse=entry.get('reverse', False), **conditions))
+    elif operation == 'scan':
+        list(table.scan(limit=entry.get('limit'), **conditions))
+    elif operation == 'put':
+        item = table.create(hash_key, range_key)
+        if entry.get('size'):
+            item['payload'] = u'x' * entry['size']
+        item.put(overwrite=True)
+    elif operation == 'delete':
+        table.create(hash_key, range_key).delete()
+    else:
+        raise ValueError('Unknown operation %r in trace.' % operation)
+
+
+def _latency_summary(latencies):
+    latencies = sorted(latencies)
+    summary = dict(count=len(latencies))
+    for name, percent in (('p50', 50), ('p95', 95), ('p99', 99)):
+        summary[name] = (latencies[min(len(latencies) - 1, len(latencies) * percent // 100)] * 1000
+                         if latencies else 0.0)
+    return summary
+
+
+def replay(trace, db=None, speed=1.0, workers=8, latency=0.0):
+    """Play back a trace written by `TraceRecorder`, and report how it went.
+
+    `trace` is an iterable of the trace's lines. Operations are started
+    on schedule, `speed` times as fast as they were recorded (`0` for
+    as fast as possible), by a pool of `workers` threads, so the Table
+    and Item classes (and their cache settings) in use are the ones
+    being measured: declare them before replaying.
+
+    Unless `db` is given, the trace is replayed against in-memory
+    stand-ins for DynamoDB, where each request takes `latency`
+    seconds, and memcached. Every item the trace found is put there
+    first, at its recorded size.
+
+    Returns a report dict: `operations`, `errors`, `elapsed`,
+    `throughput` (operations per second), `latency` and `by_operation`
+    (`count` and `p50`, `p95` and `p99` milliseconds), and the
+    `cache_hit_rate`.
+    """
+    entries = sorted((json.loads(line) for line in trace if line.strip()), key=lambda entry: entry['t'])
+    table_names = set(entry['table'] for entry in entries)
+
+    if db is None:
+        from boto.dynamodb2.fields import HashKey, RangeKey
+
+        db = DynamoDB(key='', secret='', cache=LocalCache(), track_capacity=False)
+        connection = _LocalConnection()
+        for table_name in table_names:
+            table_class = Table._table_types[table_name]
+            if table_class.hash_key_name is None:
+                raise ValueError("No Table is declared for '%s'." % table_name)
+            connection.schemas[table_name] = (table_class.hash_key_name, table_class.range_key_name)
+            schema = [HashKey(table_class.hash_key_name)]
+            if table_class.range_key_name is not None:
+                schema.append(RangeKey(table_class.range_key_name))
+            db._tables[table_name] = _boto.Table(table_name, schema=schema, connection=connection)
+
+        # Put everything the trace found, without touching the cache.
+        seeded = set()
+        for entry in entries:
+            key = (entry['table'], tuple(entry.get('key') or ()))
+            if entry.get('found') and key not in seeded:
+                seeded.add(key)
+                item = db[entry['table']].create(*key[1])
+                item['payload'] = u'x' * max(1, entry.get('size', 0))
+                with item._sharded():
+                    item.save(overwrite=True)
+        connection.latency = latency
+
+    tables = dict((table_name, db[table_name]) for table_name in table_names)
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    lock = threading.Lock()
+    stats = dict(db.stats)
+
+    def run(entry):
+        started = time.time()
+        try:
+            _replay_entry(tables[entry['table']], entry)
+        except Exception as e:
+            with lock:
+                errors[e.__class__.__name__] += 1
+        with lock:
+            latencies[entry['op']].append(time.time() - started)
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(workers)
+    started = time.time()
+    first = entries[0]['t'] if entries else 0
+    try:
+        for entry in entries:
+            if speed:
+                delay = started + (entry['t'] - first) / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            pool.apply_async(run, (entry, ))
+    finally:
+        pool.close()
+        pool.join()
+    db.flush()
+    elapsed = time.time() - started
+
+    hits = db.stats['cache_hits'] - stats.get('cache_hits', 0)
+    misses = db.stats['cache_misses'] - stats.get('cache_misses', 0)
+    return dict(
+        operations = len(entries),
+        errors = sum(errors.values()),
+        error_types = dict(errors),
+        elapsed = elapsed,
+        throughput = len(entries) / elapsed if elapsed else 0.0,
+        latency = _latency_summary(list(itertools.chain(*latencies.values()))),
+        by_operation = dict((operation, _latency_summary(values)) for operation, values in latencies.iteritems()),
+        cache_hit_rate = float(hits) / (hits + misses) if hits + misses else 0.0,
+        )
+
+
+# Finally, a command-line entry point for operational chores.
+
+
+def main(argv=None):
+    """Command-line entry point: `duo warm-cache ...`, `duo snapshot ...`, `duo build-key-filter ...`, `duo replay ...`.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='duo', description=__doc__.splitlines()[0])
+    parser.add_argument('--key', default=os.environ.get('DYNAMODB_ACCESS_KEY_ID', ''),
+                        help='AWS access key ID (default: $DYNAMODB_ACCESS_KEY_ID).')
+    parser.add_argument('--secret', default=os.environ.get('DYNAMODB_SECRET_ACCESS_KEY', ''),
+                        help='AWS secret access key (default: $DYNAMODB_SECRET_ACCESS_KEY).')
+    parser.add_argument('--memcached', default='127.0.0.1:11211',
+                        help='Comma-separated memcached servers.')
+    parser.add_argument('--module', action='append', default=[],
+                        help='Module declaring your Table and Item classes. May be repeated.')
+    commands = parser.add_subparsers(dest='command')
+
+    warm = commands.add_parser('warm-cache', help='Load items in bulk into the cache.')
+    warm.add_argument('table', help='Table name.')
+    warm.add_argument('--keys', type=argparse.FileType('r'),
+                      help='File of keys to warm, one per line, with tab-separated '
+                           'range keys ("-" for stdin). Binary keys are base64. '
+                           'Default: scan the table.')
+    warm.add_argument('--concurrency', type=int, default=4)
+    warm.add_argument('--capacity-share', type=float, default=0.5,
+                      help='Share of provisioned read capacity to use.')
+
+    snapshot = commands.add_parser('snapshot', help='Write a snapshot of a table, for a SnapshotTable.')
+    snapshot.add_argument('table', help='Table name.')
+    snapshot.add_argument('path', help='Snapshot file to write.')
+    snapshot.add_argument('--concurrency', type=int, default=4)
+
+    key_filter = commands.add_parser('build-key-filter',
+                                     help="Build a table's key filter from a scan, and store it.")
+    key_filter.add_argument('table', help='Table name.')
+    key_filter.add_argument('--concurrency', type=int, default=4)
+
+    replayer = commands.add_parser('replay', help='Replay a recorded trace against local stand-ins.')
+    replayer.add_argument('trace', type=argparse.FileType('r'), help='Trace file ("-" for stdin).')
+    replayer.add_argument('--speed', type=float, default=1.0,
+                          help='Times as fast as recorded (0: as fast as possible).')
+    replayer.add_argument('--workers', type=int, default=8)
+    replayer.add_argument('--latency', type=float, default=5.0,
+                          help='Simulated DynamoDB latency, in milliseconds.')
+
+    args = parser.parse_args(argv)
+    for module in args.module:
+        importlib.import_module(module)
+
+    if args.command == 'replay':
+        report = replay(args.trace, speed=args.speed, workers=args.workers, latency=args.latency / 1000)
+        sys.stdout.write('%(operations)d operations in %(elapsed).1fs (%(throughput).1f/s), '
+                         '%(errors)d errors, cache hit rate %(hit_rate).1f%%\n' % dict(
+                             report, hit_rate=report['cache_hit_rate'] * 100))
+        for operation, summary in sorted(report['by_operation'].iteritems()):
+            sys.stdout.write('%-10s %6d  p50 %7.1fms  p95 %7.1fms  p99 %7.1fms\n' % (
+                operation, summary['count'], summary['p50'], summary['p95'], summary['p99']))
+        return
+
+    try:
+        import pylibmc
+        cache = pylibmc.Client(args.memcached.split(','), binary=True)
+    except ImportError:
+        import memcache
+        cache = memcache.Client(args.memcached.split(','))
+
+    table = DynamoDB(key=args.key, secret=args.secret, cache=cache)[args.table]
+
+    if args.command == 'warm-cache':
+        def progress(report):
+            sys.stderr.write('\r%(requested)d requested, %(cached)d cached, %(loaded)d loaded, '
+                             '%(missing)d missing, hit rate %(hit_rate).1f%%' % dict(
+                                 report, hit_rate=report['hit_rate'] * 100))
+
+        if args.keys is not None:
+            keys = (table._parse_key(line.rstrip('\n').split('\t')) for line in args.keys if line.strip())
+            report = table.warm_cache(keys=keys, concurrency=args.concurrency,
+                                      capacity_share=args.capacity_share, progress=progress)
+        else:
+            report = table.warm_cache(scan={}, concurrency=args.concurrency,
+                                      capacity_share=args.capacity_share, progress=progress)
+        sys.stderr.write('\nDone in %.1fs.\n' % report['elapsed'])
+    elif args.command == 'snapshot':
+        started = time.time()
+        count = table.snapshot(args.path, concurrency=args.concurrency)
+        sys.stderr.write('%d items in %.1fs.\n' % (count, time.time() - started))
+    elif args.command == 'build-key-filter':
+        started = time.time()
+        built = table.build_key_filter(concurrency=args.concurrency)
+        sys.stderr.write('%d keys in %.1fs; false positive rate %.2f%%.\n' % (
+            len(built), time.time() - started, built.false_positive_rate * 100))
+
+
+if __name__ == '__main__':
+    main()
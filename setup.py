@@ -25,6 +25,9 @@ SETUP = dict(
     install_requires = INSTALL_REQUIRES,
     tests_require = TESTS_REQUIRE,
     test_suite = 'nose.collector',
+    entry_points = {
+        'console_scripts': ['duo = duo:main'],
+        },
 
     package_data = {
         '': ['*.txt', '*.html'],
@@ -8,7 +8,12 @@ try:
 except ImportError:
     import unittest
 
+import os
+import sys
 import datetime
+import threading
+import subprocess
+import warnings
     
 import mock
 
@@ -330,3 +335,1180 @@ class DuoTests(DynamoDBTests):
         self.assertIsInstance(item['place'], int)
         self.assertEqual(item['place'], 1)
         self.assertIs(item.place, Bar)
+
+
+class FakeCache(dict):
+    """A dict that quacks like a memcached client.
+    """
+    def get(self, key):
+        return super(FakeCache, self).get(key)
+
+    def set(self, key, value, duration=0):
+        self[key] = value
+        return True
+
+    def delete(self, key):
+        self.pop(key, None)
+        return True
+
+    def get_multi(self, keys):
+        return dict((key, self[key]) for key in keys if key in self)
+
+    def set_multi(self, mapping, duration=0):
+        self.update(mapping)
+        return []
+
+    def add(self, key, value, duration=0):
+        if key in self:
+            return False
+        self[key] = value
+        return True
+
+    def incr(self, key, delta=1):
+        if key not in self:
+            return None
+        self[key] += delta
+        return self[key]
+
+
+class TableTests(unittest.TestCase):
+    """Tests against a boto `dynamodb2` table with a mocked-out connection.
+    """
+    table_name = 'test_table'
+    hash_key_name = 'test_hash_key'
+    range_key_name = 'test_range_key'
+
+    def setUp(self):
+        super(TableTests, self).setUp()
+        connect_patcher = self.connect_dynamodb_patcher = mock.patch('boto.connect_dynamodb')
+        connect_patcher.start()
+
+        from boto.dynamodb2.fields import HashKey, RangeKey
+        from boto.dynamodb2.table import Table
+
+        import duo
+        reload(duo)
+        self.duo = duo
+        self.cache = FakeCache()
+        self.db = duo.DynamoDB(key='foo', secret='bar', cache=self.cache)
+        self.connection = mock.Mock()
+        schema = [HashKey(self.hash_key_name)]
+        if self.range_key_name is not None:
+            schema.append(RangeKey(self.range_key_name))
+        self.boto_table = Table(self.table_name, schema=schema, connection=self.connection)
+        self.db._tables[self.table_name] = self.boto_table
+
+        class TestTableSubclass(duo.Table):
+            table_name = self.table_name
+            hash_key_name = self.hash_key_name
+            range_key_name = self.range_key_name
+
+        self.table_class = TestTableSubclass
+
+    def tearDown(self):
+        self.connect_dynamodb_patcher.stop()
+
+
+class IndexTests(TableTests):
+    def setUp(self):
+        super(IndexTests, self).setUp()
+
+        class TestItemSubclass(self.duo.Item):
+            table_name = self.table_name
+
+            by_author = self.duo.GlobalIndex('author', 'created', projection=['title'])
+            by_date = self.duo.LocalIndex(range_key='created', name='created-index')
+
+        self.item_class = TestItemSubclass
+        self.table = self.db[self.table_name]
+
+    def test_indexes_should_be_registered_by_name(self):
+        self.assertEqual(sorted(self.item_class._indexes), ['by_author', 'created-index'])
+
+    def test_plan_should_use_table_for_its_own_keys(self):
+        plan = self.table.plan_query(test_hash_key__eq='fred', test_range_key__gt='a')
+        self.assertIs(plan.index, None)
+        self.assertEqual(plan.query_filter, {})
+
+    def test_plan_should_pick_the_index_keyed_on_the_conditions(self):
+        plan = self.table.plan_query(attributes=['title'], author__eq='fred', created__gt=5)
+        self.assertEqual(plan.index, 'by_author')
+        self.assertEqual(plan.key_conditions, dict(author__eq='fred', created__gt=5))
+
+    def test_plan_should_skip_global_indexes_missing_projected_attributes(self):
+        plan = self.table.plan_query(attributes=['title'], author__eq='fred')
+        self.assertEqual(plan.index, 'by_author')
+        with self.assertRaises(ValueError):
+            self.table.plan_query(attributes=['body'], author__eq='fred')
+
+    def test_query_should_warn_when_falling_back_to_a_filter(self):
+        self.boto_table.query_2 = mock.Mock()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.table.query(test_hash_key__eq='fred', created__gt=5, title__eq='x')
+        self.assertEqual(caught[0].category, self.duo.QueryPlanWarning)
+        kwargs = self.boto_table.query_2.call_args[1]
+        self.assertEqual(kwargs['index'], 'created-index')
+        self.assertEqual(kwargs['query_filter'], {'title__eq': 'x'})
+
+
+class PartialItemTests(TableTests):
+    def setUp(self):
+        super(PartialItemTests, self).setUp()
+
+        class TestItemSubclass(self.duo.Item):
+            table_name = self.table_name
+
+            title = self.duo.UnicodeField()
+            body = self.duo.UnicodeField()
+
+        self.item_class = TestItemSubclass
+        self.table = self.db[self.table_name]
+
+    def mock_items(self, *attrs):
+        items = []
+        for i in range(3):
+            data = {self.hash_key_name: 'fred', self.range_key_name: str(i),
+                    'title': u'title %s' % i, 'body': u'body %s' % i}
+            items.append(dict((k, v) for k, v in data.items()
+                              if k in attrs or k in (self.hash_key_name, self.range_key_name)))
+        return items
+
+    def test_query_with_fields_should_fetch_only_those_attributes(self):
+        self.boto_table.query_2 = mock.Mock(return_value=iter(self.mock_items('title')))
+        items = list(self.table.query(test_hash_key__eq='fred', fields=[self.item_class.title]))
+        self.assertEqual(self.boto_table.query_2.call_args[1]['attributes'],
+                         sorted(['title', self.hash_key_name, self.range_key_name]))
+        self.assertTrue(all(item.is_partial for item in items))
+        self.assertEqual(items[0].title, u'title 0')
+
+    def test_reading_a_missing_field_should_load_all_siblings_in_one_batch(self):
+        self.boto_table.query_2 = mock.Mock(return_value=iter(self.mock_items('title')))
+        self.boto_table.batch_get = mock.Mock(return_value=iter(self.mock_items('title', 'body')))
+        items = list(self.table.query(test_hash_key__eq='fred', fields=['title']))
+
+        self.assertEqual(items[1].body, u'body 1')
+        self.assertEqual(self.boto_table.batch_get.call_count, 1)
+        self.assertEqual(len(self.boto_table.batch_get.call_args[1]['keys']), 3)
+        self.assertFalse(any(item.is_partial for item in items))
+        self.assertEqual(items[2].body, u'body 2')
+        self.assertEqual(self.boto_table.batch_get.call_count, 1)
+
+    def test_items_missing_from_the_batch_should_stay_partial_and_uncached(self):
+        self.item_class.cache_duration = 30
+        self.boto_table.query_2 = mock.Mock(return_value=iter(self.mock_items('title')))
+        self.boto_table.batch_get = mock.Mock(
+            return_value=iter([self.mock_items('title', 'body')[i] for i in (0, 2)]))
+        items = list(self.table.query(test_hash_key__eq='fred', fields=['title']))
+        self.cache[self.table._get_cache_key('fred', '1')] = [('title', u'stale')]
+
+        self.assertEqual(items[0].body, u'body 0')
+        self.assertFalse(items[0].is_partial)
+        self.assertTrue(items[1].is_partial)
+        self.assertIsNone(self.table._get_cache('fred', '1'))
+        self.assertEqual(self.table._get_cache('fred', '2')['body'], u'body 2')
+
+
+class WarmCacheTests(TableTests):
+    def setUp(self):
+        super(WarmCacheTests, self).setUp()
+
+        class TestItemSubclass(self.duo.Item):
+            table_name = self.table_name
+            cache_duration = 30
+
+        self.table = self.db[self.table_name]
+
+    def mock_batch_get(self, keys):
+        return iter([dict(key, title=u'found') for key in keys
+                     if key[self.range_key_name] != 'missing'])
+
+    def test_warm_cache_should_load_uncached_keys_in_batches(self):
+        self.boto_table.batch_get = mock.Mock(side_effect=self.mock_batch_get)
+        self.cache[self.table._get_cache_key('fred', 'cached')] = [('title', u'cached')]
+
+        keys = [('fred', 'cached'), ('fred', 'missing')] + [('fred', str(i)) for i in range(10)]
+        report = self.table.warm_cache(keys=keys, concurrency=2, capacity_share=None)
+
+        self.assertEqual(report['requested'], 12)
+        self.assertEqual(report['cached'], 1)
+        self.assertEqual(report['loaded'], 10)
+        self.assertEqual(report['missing'], 1)
+        self.assertEqual(dict(self.cache[self.table._get_cache_key('fred', '3')])['title'], u'found')
+        item = self.table['fred', '3']
+        self.assertEqual(item['title'], u'found')
+        self.assertEqual(self.db.stats['cache_hits'], 1)
+
+    def test_keys_given_as_text_should_take_the_schemas_types(self):
+        from decimal import Decimal
+        from boto.dynamodb2.fields import HashKey, RangeKey
+        from boto.dynamodb2.types import NUMBER
+
+        self.boto_table.schema = [HashKey(self.hash_key_name), RangeKey(self.range_key_name, data_type=NUMBER)]
+        self.assertEqual(self.table._parse_key(['fred', '5']), ('fred', Decimal(5)))
+        self.assertEqual(self.table._parse_key(['fred']), ('fred', ))
+
+    def test_warm_cache_should_require_caching(self):
+        self.table.cache = None
+        with self.assertRaises(ValueError):
+            self.table.warm_cache(keys=['fred'])
+
+
+class CacheGenerationTests(TableTests):
+    def setUp(self):
+        super(CacheGenerationTests, self).setUp()
+
+        class TestItemSubclass(self.duo.Item):
+            table_name = self.table_name
+            cache_duration = 30
+
+        self.table_class.cache_generations = True
+        self.table = self.db[self.table_name]
+
+    def test_invalidate_all_should_orphan_cached_items(self):
+        item = self.table.create('fred', 'flintstone', title=u'cached')
+        item._set_cache()
+        self.assertEqual(self.table['fred', 'flintstone']['title'], u'cached')
+
+        self.table.invalidate_all()
+        self.assertIs(self.table._get_cache('fred', 'flintstone'), None)
+
+    def test_generation_should_be_held_in_process_memory(self):
+        self.table._get_generation()
+        self.cache.get = mock.Mock(side_effect=AssertionError('cache hit for the generation'))
+        self.table._get_generation()
+
+    def test_invalidate_all_should_require_generations(self):
+        self.table_class.cache_generations = False
+        with self.assertRaises(ValueError):
+            self.table.invalidate_all()
+
+
+class CacheCodecTests(TableTests):
+    def setUp(self):
+        super(CacheCodecTests, self).setUp()
+
+        class TestItemSubclass(self.duo.Item):
+            table_name = self.table_name
+            cache_duration = 30
+            cache_codec = self.duo.MarshalCodec(compress_threshold=100)
+
+            title = self.duo.UnicodeField()
+            count = self.duo.IntegerField()
+
+        self.item_class = TestItemSubclass
+        self.table = self.db[self.table_name]
+
+    def test_marshal_codec_should_round_trip_dynamodb_types(self):
+        from decimal import Decimal
+        from boto.dynamodb.types import Binary
+        data = {self.hash_key_name: u'fred', 'title': u'hello', 'count': Decimal('1.5'),
+                'tags': set([u'a', u'b']), 'blob': Binary('\x00\x01'), 'nums': set([Decimal(3)])}
+        codec = self.item_class.cache_codec
+        self.assertEqual(codec.loads(self.item_class, codec.dumps(self.item_class, data)), data)
+
+    def test_marshal_codec_should_compress_large_entries(self):
+        codec = self.item_class.cache_codec
+        data = {'title': u'x' * 1000}
+        value = codec.dumps(self.item_class, data)
+        self.assertLess(len(value), 100)
+        self.assertEqual(codec.loads(self.item_class, value), data)
+
+    def test_stale_entries_should_be_cache_misses(self):
+        item = self.table.create('fred', 'flintstone', title=u'cached')
+        item._set_cache()
+        self.assertEqual(self.table._get_cache('fred', 'flintstone')['title'], u'cached')
+
+        self.item_class.cache_schema_version = 1
+        self.assertIs(self.table._get_cache('fred', 'flintstone'), None)
+        self.assertEqual(self.db.stats['cache_stale'], 1)
+
+    def test_rolling_back_to_pickle_codec_should_miss_marshal_entries(self):
+        item = self.table.create('fred', 'flintstone', title=u'cached')
+        item._set_cache()
+
+        self.item_class.cache_codec = self.duo.PickleCodec()
+        self.assertIs(self.table._get_cache('fred', 'flintstone'), None)
+        self.assertEqual(self.db.stats['cache_stale'], 1)
+
+    def test_corrupt_marshal_entries_should_be_cache_misses(self):
+        codec = self.item_class.cache_codec
+        value = codec.dumps(self.item_class, {'title': u'x' * 1000})
+        self.assertIs(codec.loads(self.item_class, value[:-10]), None)
+        self.assertIs(codec.loads(self.item_class, value[:codec.header.size] + 'garbage'), None)
+
+
+class WriteBehindTests(TableTests):
+    def setUp(self):
+        super(WriteBehindTests, self).setUp()
+
+        class TestItemSubclass(self.duo.Item):
+            table_name = self.table_name
+            cache_duration = 30
+            write_behind = True
+            write_behind_interval = 60
+            write_behind_max_queue = 2
+            write_behind_policy = 'drop'
+
+        self.item_class = TestItemSubclass
+        self.table = self.db[self.table_name]
+        self.boto_table.batch_write = mock.MagicMock()
+        self.batch = self.boto_table.batch_write.return_value.__enter__.return_value
+
+    def test_put_should_update_the_cache_and_defer_the_write(self):
+        item = self.table.create('fred', 'flintstone', title=u'hello')
+        item.save = mock.Mock()
+        self.assertTrue(item.put())
+        self.assertFalse(item.is_new)
+        self.assertFalse(item.save.called)
+        self.assertEqual(self.table['fred', 'flintstone']['title'], u'hello')
+        self.assertFalse(self.batch.put_item.called)
+
+        self.db.flush()
+        self.batch.put_item.assert_called_once_with(dict(
+            test_hash_key='fred', test_range_key='flintstone', title=u'hello'), overwrite=True)
+
+    def test_threads_should_share_one_queue_per_table(self):
+        import time
+
+        created, lock = [], threading.Lock()
+
+        def make_queue(*args, **kwargs):
+            time.sleep(0.01)
+            queue = mock.Mock()
+            with lock:
+                created.append(queue)
+            return queue
+
+        queues = []
+        item = self.table.create('fred', 'flintstone')
+        with mock.patch.object(self.duo, '_WriteBehindQueue', side_effect=make_queue):
+            threads = [threading.Thread(target=lambda: queues.append(self.db._get_write_behind_queue(item)))
+                       for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(created), 1)
+        self.assertEqual(set(map(id, queues)), set([id(created[0])]))
+
+    def test_repeated_puts_should_be_coalesced(self):
+        for title in (u'one', u'two', u'three'):
+            self.table.create('fred', 'flintstone', title=title).put()
+        self.db.flush()
+        self.assertEqual(self.batch.put_item.call_count, 1)
+        self.assertEqual(self.batch.put_item.call_args[0][0]['title'], u'three')
+
+    def test_full_queue_should_apply_the_backpressure_policy(self):
+        self.assertTrue(self.table.create('fred', '1').put())
+        self.assertTrue(self.table.create('fred', '2').put())
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            self.assertFalse(self.table.create('fred', '3').put())
+
+    def test_delete_should_discard_a_pending_put(self):
+        item = self.table.create('fred', 'flintstone')
+        item.put()
+        self.boto_table.delete_item = mock.Mock(return_value=True)
+        item.delete()
+        self.db.flush()
+        self.assertFalse(self.batch.put_item.called)
+
+
+class CompressedFieldTests(TableTests):
+    def setUp(self):
+        super(CompressedFieldTests, self).setUp()
+
+        class TestItemSubclass(self.duo.Item):
+            table_name = self.table_name
+
+            text = self.duo.CompressedTextField(compress_threshold=100)
+            data = self.duo.CompressedJSONField(compress_threshold=100)
+
+        self.table = self.db[self.table_name]
+        self.item = self.table.create('fred', 'flintstone')
+
+    def test_small_values_should_be_stored_as_strings(self):
+        self.item.text = 'hello'
+        self.assertEqual(self.item['text'], u'hello')
+        self.assertEqual(self.item.text, u'hello')
+
+    def test_large_values_should_be_stored_compressed(self):
+        from boto.dynamodb.types import Binary
+        self.item.text = u'ü' * 1000
+        self.assertIsInstance(self.item['text'], Binary)
+        self.assertLess(len(self.item['text'].value), 100)
+        self.assertEqual(self.item.text, u'ü' * 1000)
+
+    def test_json_values_should_be_decompressed_once(self):
+        value = {'numbers': range(100)}
+        self.item.data = value
+        self.assertEqual(self.item.data, value)
+        with mock.patch('zlib.decompress') as decompress:
+            self.assertIs(self.item.data, self.item.data)
+            self.assertFalse(decompress.called)
+
+
+class WriteShardTests(TableTests):
+    def setUp(self):
+        super(WriteShardTests, self).setUp()
+        self.table_class.write_shards = 4
+        self.table = self.db[self.table_name]
+
+    def test_put_should_write_to_the_range_keys_shard(self):
+        self.boto_table._put_item = mock.Mock(return_value=True)
+        item = self.table.create('fred', 'flintstone')
+        item.put()
+
+        shard = self.table._shard_for('flintstone')
+        written = self.boto_table._put_item.call_args[0][0]
+        self.assertEqual(written[self.hash_key_name], {'S': u'fred#%d' % shard})
+        self.assertEqual(item[self.hash_key_name], 'fred')
+
+    def test_get_item_should_read_the_range_keys_shard(self):
+        shard = self.table._shard_for('flintstone')
+        self.connection.get_item.return_value = {'Item': {
+            self.hash_key_name: {'S': u'fred#%d' % shard},
+            self.range_key_name: {'S': 'flintstone'}}}
+        item = self.table.get_item('fred', 'flintstone')
+
+        raw_key = self.connection.get_item.call_args[0][1]
+        self.assertEqual(raw_key[self.hash_key_name], {'S': u'fred#%d' % shard})
+        self.assertEqual(item[self.hash_key_name], u'fred')
+
+    def test_query_should_merge_results_from_every_shard(self):
+        import threading
+        from boto.dynamodb2.items import Item
+
+        # Mock's own call counting isn't thread-safe.
+        queried, lock = [], threading.Lock()
+
+        def query_2(limit=None, reverse=False, **kwargs):
+            hash_key = kwargs['test_hash_key__eq']
+            with lock:
+                queried.append(hash_key)
+            shard = int(hash_key.rpartition('#')[2])
+            return iter([Item(self.boto_table, data={
+                self.hash_key_name: hash_key, self.range_key_name: str(shard + i)})
+                for i in (0, 4)])
+        self.boto_table.query_2 = mock.Mock(side_effect=query_2)
+
+        results = self.table.query(test_hash_key__eq='fred', limit=5)
+        self.assertEqual(sorted(queried), [u'fred#0', u'fred#1', u'fred#2', u'fred#3'])
+        self.assertEqual([item[self.range_key_name] for item in results], ['0', '1', '2', '3', '4'])
+        self.assertEqual(set(item[self.hash_key_name] for item in results), set(['fred']))
+
+    def test_local_index_queries_should_merge_results_from_every_shard(self):
+        from boto.dynamodb2.items import Item
+
+        class TestItemSubclass(self.duo.Item):
+            table_name = self.table_name
+            by_date = self.duo.LocalIndex('date')
+
+        queried, lock = [], threading.Lock()
+
+        def query_2(limit=None, index=None, reverse=False, **kwargs):
+            hash_key = kwargs['test_hash_key__eq']
+            with lock:
+                queried.append((index, hash_key))
+            shard = int(hash_key.rpartition('#')[2])
+            return iter([Item(self.boto_table, data={
+                self.hash_key_name: hash_key, self.range_key_name: 'x%d' % i, 'date': 10 * i + shard})
+                for i in (1, 2)])
+        self.boto_table.query_2 = mock.Mock(side_effect=query_2)
+
+        results = self.table.query(test_hash_key__eq='fred', date__gt=5, limit=5)
+        self.assertEqual(sorted(queried), [('by_date', u'fred#%d' % shard) for shard in range(4)])
+        self.assertEqual([item['date'] for item in results], [10, 11, 12, 13, 20])
+        self.assertEqual(set(item[self.hash_key_name] for item in results), set(['fred']))
+
+    def test_items_written_before_sharding_should_keep_their_hash_keys(self):
+        from decimal import Decimal
+        from boto.dynamodb2.items import Item
+
+        for hash_key in (u'fred', u'fred#flintstone', Decimal(7)):
+            item = Item(self.boto_table, data={self.hash_key_name: hash_key, self.range_key_name: 'x'})
+            self.assertEqual(self.table._unshard(item)[self.hash_key_name], hash_key)
+
+    def test_non_string_hash_keys_should_be_rejected(self):
+        self.assertRaises(ValueError, self.table.get_item, 7, 'flintstone')
+        self.assertRaises(ValueError, self.table.create(7, 'flintstone').put)
+
+
+class ShardedCounterTests(TableTests):
+    range_key_name = None
+
+    def setUp(self):
+        super(ShardedCounterTests, self).setUp()
+        self.table_class.write_shards = 3
+        self.table = self.db[self.table_name]
+
+    def test_counter_should_increment_one_shard_and_sum_all_of_them(self):
+        from decimal import Decimal
+        counter = self.table.counter('views')
+        counter.incr(2)
+        raw_key = self.connection.update_item.call_args[0][1]
+        self.assertIn(raw_key[self.hash_key_name]['S'], [u'views#0', u'views#1', u'views#2'])
+
+        self.boto_table.batch_get = mock.Mock(return_value=iter([
+            {'count': Decimal(2)}, {'count': Decimal(3)}, {}]))
+        self.assertEqual(counter.value, 5)
+        self.assertEqual(len(self.boto_table.batch_get.call_args[1]['keys']), 3)
+
+    def test_items_should_not_be_sharded_on_a_hash_only_table(self):
+        self.connection.get_item.return_value = {'Item': {self.hash_key_name: {'S': 'views'}}}
+        item = self.table['views']
+        self.assertEqual(self.connection.get_item.call_args[0][1][self.hash_key_name], {'S': 'views'})
+        self.assertEqual(item[self.hash_key_name], 'views')
+
+        self.boto_table._put_item = mock.Mock(return_value=True)
+        item['title'] = u'hello'
+        item.put()
+        written = self.boto_table._put_item.call_args[0][0]
+        self.assertEqual(written[self.hash_key_name], {'S': 'views'})
+
+
+class HedgedReadTests(TableTests):
+    def setUp(self):
+        super(HedgedReadTests, self).setUp()
+        self.table_class.hedge_after = 0.01
+        self.table_class.hedge_budget = 1.0
+        self.table = self.db[self.table_name]
+        self.answer = {'Item': {self.hash_key_name: {'S': 'fred'}, self.range_key_name: {'S': 'flintstone'}}}
+
+    def test_slow_reads_should_be_hedged(self):
+        import time
+        calls = []
+
+        def get_item(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                time.sleep(0.5)
+            return self.answer
+        self.connection.get_item.side_effect = get_item
+
+        started = time.time()
+        item = self.table.get_item('fred', 'flintstone')
+        self.assertLess(time.time() - started, 0.4)
+        self.assertEqual(item[self.range_key_name], 'flintstone')
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.db.stats['hedged_reads'], 1)
+        self.assertEqual(self.db.stats['hedge_wins'], 1)
+
+    def test_hedges_should_be_limited_by_the_budget(self):
+        import time
+        self.table_class.hedge_budget = 0.0
+
+        def get_item(*args, **kwargs):
+            time.sleep(0.05)
+            return self.answer
+        self.connection.get_item.side_effect = get_item
+
+        self.table.get_item('fred', 'flintstone')
+        self.assertEqual(self.connection.get_item.call_count, 1)
+        self.assertEqual(self.db.stats['hedged_reads'], 0)
+
+
+    def test_p95_hedging_should_start_after_warm_up_reads(self):
+        import time
+        self.table_class.hedge_after = 'p95'
+        self.connection.get_item.return_value = self.answer
+        for _ in range(20):
+            self.table.get_item('fred', 'flintstone')
+        self.assertEqual(self.db.stats['hedged_reads'], 0)
+
+        calls = []
+
+        def get_item(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                time.sleep(0.5)
+            return self.answer
+        self.connection.get_item.side_effect = get_item
+
+        self.table.get_item('fred', 'flintstone')
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.db.stats['hedged_reads'], 1)
+
+
+class CapacityTests(TableTests):
+    def setUp(self):
+        super(CapacityTests, self).setUp()
+
+        class TestItemSubclass(self.duo.Item):
+            table_name = self.table_name
+
+        self.boto_table.connection = self.duo._CapacityConnection(self.connection, self.db)
+        self.table = self.db[self.table_name]
+
+    def test_reads_and_writes_should_be_counted_by_operation_index_and_tag(self):
+        self.connection.get_item.return_value = {
+            'Item': {self.hash_key_name: {'S': 'fred'}, self.range_key_name: {'S': 'flintstone'}},
+            'ConsumedCapacity': {'TableName': self.table_name, 'CapacityUnits': 0.5},
+            }
+        self.connection.put_item.return_value = {
+            'ConsumedCapacity': {'TableName': self.table_name, 'CapacityUnits': 3,
+                                 'Table': {'CapacityUnits': 1},
+                                 'GlobalSecondaryIndexes': {'by_author': {'CapacityUnits': 2}}},
+            }
+
+        item = self.table.get_item('fred', 'flintstone')
+        self.assertEqual(self.connection.get_item.call_args[1]['return_consumed_capacity'], 'INDEXES')
+        item['title'] = u'hello'
+        with self.db.capacity_tag('edit'):
+            item.put()
+
+        report = self.db.capacity_report()
+        self.assertEqual(report['read_units'], 0.5)
+        self.assertEqual(report['write_units'], 3)
+        self.assertEqual(report['by_class']['TestItemSubclass'], dict(read=0.5, write=3))
+        self.assertEqual(report['by_index'][self.table_name, 'by_author'], dict(read=0, write=2))
+        self.assertEqual(report['by_operation']['put'], dict(read=0, write=3))
+        self.assertEqual(report['by_tag']['edit'], dict(read=0, write=3))
+        self.assertEqual(report['top'][0], ((self.table_name, 'by_author', 'put', 'edit'), 2))
+        self.assertEqual(report['cache_share'], 0.0)
+
+    def test_hedged_reads_should_keep_the_callers_tag(self):
+        self.table_class.hedge_after = 0.01
+        self.table_class.hedge_budget = 0.0
+        self.connection.get_item.return_value = {
+            'Item': {self.hash_key_name: {'S': 'fred'}, self.range_key_name: {'S': 'flintstone'}},
+            'ConsumedCapacity': {'TableName': self.table_name, 'CapacityUnits': 0.5},
+            }
+
+        with self.db.capacity_tag('checkout'):
+            self.table.get_item('fred', 'flintstone')
+
+        report = self.db.capacity_report()
+        self.assertEqual(report['by_tag']['checkout'], dict(read=0.5, write=0))
+        self.assertNotIn(None, report['by_tag'])
+
+
+class KeyFilterTests(TableTests):
+    def setUp(self):
+        super(KeyFilterTests, self).setUp()
+        self.table_class.key_filter = True
+        self.table = self.db[self.table_name]
+
+    def test_filter_should_find_added_keys_and_few_others(self):
+        from decimal import Decimal
+
+        key_filter = self.duo.KeyFilter.for_capacity(1000, 0.01)
+        for i in range(1000):
+            key_filter.add((u'fred', i))
+        key_filter = self.duo.KeyFilter.loads(key_filter.dumps())
+
+        self.assertTrue(all((u'fred', i) in key_filter for i in range(1000)))
+        self.assertIn(('fred', Decimal(5)), key_filter)
+        false_positives = sum((u'barney', i) in key_filter for i in range(10000))
+        self.assertLess(false_positives, 300)
+        self.assertAlmostEqual(key_filter.false_positive_rate, 0.01, delta=0.005)
+
+    def test_lookups_of_absent_keys_should_skip_the_read(self):
+        from boto.dynamodb2.items import Item
+
+        self.boto_table.scan = mock.Mock(return_value=iter([Item(self.boto_table, data={
+            self.hash_key_name: u'fred', self.range_key_name: u'flintstone'})]))
+        self.table.build_key_filter(concurrency=1)
+        self.assertEqual(self.boto_table.scan.call_args[1]['attributes'],
+                         [self.hash_key_name, self.range_key_name])
+
+        item = self.table['barney', 'rubble']
+        self.assertTrue(item.is_new)
+        self.assertFalse(self.connection.get_item.called)
+        self.assertEqual(self.db.stats['key_filter_skips'], 1)
+
+        self.connection.get_item.return_value = {'Item': {
+            self.hash_key_name: {'S': 'fred'}, self.range_key_name: {'S': 'flintstone'}}}
+        self.assertFalse(self.table['fred', 'flintstone'].is_new)
+
+        self.boto_table._put_item = mock.Mock(return_value=True)
+        item.put()
+        self.assertIn(('barney', 'rubble'), self.table.get_key_filter())
+
+    def test_keys_put_by_other_processes_should_not_be_skipped(self):
+        self.boto_table.scan = mock.Mock(return_value=iter([]))
+        self.table.build_key_filter(concurrency=1)
+        self.assertTrue(self.table['barney', 'rubble'].is_new)
+        self.assertEqual(self.db.stats['key_filter_skips'], 1)
+
+        # Another process, with key filters of its own, puts the key.
+        other = self.db[self.table_name]
+        other._key_filters = {}
+        self.boto_table._put_item = mock.Mock(return_value=True)
+        other.create('barney', 'rubble').put()
+
+        self.connection.get_item.return_value = {'Item': {
+            self.hash_key_name: {'S': 'barney'}, self.range_key_name: {'S': 'rubble'}}}
+        self.assertFalse(self.table['barney', 'rubble'].is_new)
+        self.assertEqual(self.db.stats['key_filter_skips'], 1)
+
+    def test_filter_should_not_be_used_if_the_log_loses_keys(self):
+        self.boto_table.scan = mock.Mock(return_value=iter([]))
+        key_filter = self.table.build_key_filter(concurrency=1)
+        self.boto_table._put_item = mock.Mock(return_value=True)
+        self.table.create('barney', 'rubble').put()
+        self.table.create('wilma', 'flintstone').put()
+        self.cache.delete(self.table._key_filter_log_key(key_filter.position + 1))
+
+        self.connection.get_item.return_value = {}
+        self.assertTrue(self.table['betty', 'rubble'].is_new)
+        self.assertEqual(self.db.stats['key_filter_skips'], 0)
+        self.assertTrue(self.connection.get_item.called)
+        self.assertEqual(self.db.stats['key_filter_lost'], 1)
+
+    def test_key_filter_should_require_a_cache(self):
+        self.table.cache = None
+        with self.assertRaises(ValueError):
+            self.table.get_key_filter()
+
+
+class BulkDeleteTests(TableTests):
+    def setUp(self):
+        super(BulkDeleteTests, self).setUp()
+
+        class TestItemSubclass(self.duo.Item):
+            table_name = self.table_name
+            cache_duration = 30
+
+        self.table = self.db[self.table_name]
+        self.boto_table.batch_write = mock.MagicMock()
+        self.batch = self.boto_table.batch_write.return_value.__enter__.return_value
+
+        # Deletes are made from several threads, and Mock's own call
+        # counting isn't thread-safe, so record calls under a lock.
+        self.lock = threading.Lock()
+        self.batches, self.deleted = [], []
+
+        def batch_write():
+            with self.lock:
+                self.batches.append(None)
+            return mock.DEFAULT
+
+        def delete_item(**key):
+            with self.lock:
+                self.deleted.append(key)
+        self.boto_table.batch_write.side_effect = batch_write
+        self.batch.delete_item.side_effect = delete_item
+
+    def test_delete_many_should_batch_deletes_and_invalidate_the_cache(self):
+        keys = [('fred', str(i)) for i in range(60)]
+        for hash_key, range_key in keys:
+            self.table.create(hash_key, range_key)._set_cache()
+        self.assertEqual(len(self.cache), 60)
+
+        self.assertEqual(self.table.delete_many(keys, concurrency=2, capacity_share=None), 60)
+        self.assertEqual(len(self.batches), 4)
+        self.assertEqual(len(self.deleted), 60)
+        self.assertIn({'test_hash_key': 'fred', 'test_range_key': '59'}, self.deleted)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_truncate_should_delete_every_scanned_key(self):
+        from boto.dynamodb2.items import Item
+
+        scans = []
+
+        def scan(segment=None, total_segments=None, attributes=None):
+            with self.lock:
+                scans.append((segment, total_segments, attributes))
+            return iter([Item(self.boto_table, data={
+                self.hash_key_name: u'segment%d' % segment, self.range_key_name: str(i)})
+                for i in range(30)])
+        self.boto_table.scan = scan
+        self.boto_table.describe = mock.Mock(return_value={
+            'Table': {'ProvisionedThroughput': {'WriteCapacityUnits': 10000}}})
+
+        self.assertEqual(self.table.truncate(segments=3), 90)
+        key_names = [self.hash_key_name, self.range_key_name]
+        self.assertEqual(sorted(scans), [(0, 3, key_names), (1, 3, key_names), (2, 3, key_names)])
+        self.assertEqual(len(self.deleted), 90)
+
+
+class TraceTests(TableTests):
+    def setUp(self):
+        super(TraceTests, self).setUp()
+
+        class TestItemSubclass(self.duo.Item):
+            table_name = self.table_name
+            cache_duration = 30
+
+        self.table = self.db[self.table_name]
+
+    def test_recorded_trace_should_be_anonymous_and_replayable(self):
+        import json
+        import StringIO
+
+        trace = StringIO.StringIO()
+        recorder = self.db.recorder = self.duo.TraceRecorder(trace, salt='pepper')
+        self.connection.get_item.return_value = {'Item': {
+            self.hash_key_name: {'S': 'fred'}, self.range_key_name: {'S': 'flintstone'}}}
+        self.table['fred', 'flintstone']
+        self.table['fred', 'flintstone']
+        self.connection.get_item.return_value = {}
+        self.table['barney', 'rubble']
+        self.boto_table._put_item = mock.Mock(return_value=True)
+        self.table.create('wilma', 'flintstone', title=u'hello').put()
+
+        entries = [json.loads(line) for line in trace.getvalue().splitlines()]
+        self.assertEqual([entry['op'] for entry in entries], ['get', 'get', 'get', 'put'])
+        self.assertNotIn('fred', trace.getvalue())
+        self.assertEqual(entries[0]['key'], [recorder._hash('fred'), recorder._hash('flintstone')])
+        self.assertEqual([entry['found'] for entry in entries[:3]], [True, True, False])
+        self.assertGreater(entries[3]['size'], 0)
+
+        self.db.recorder = None
+        report = self.duo.replay(trace.getvalue().splitlines(), speed=0, workers=1)
+        self.assertEqual(report['operations'], 4)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(report['by_operation']['get']['count'], 3)
+        self.assertAlmostEqual(report['cache_hit_rate'], 1.0 / 3)
+
+    def test_queries_should_be_timed_while_their_results_are_read(self):
+        import json
+        import StringIO
+        import time
+
+        trace = StringIO.StringIO()
+        self.db.recorder = self.duo.TraceRecorder(trace)
+
+        def query(*args, **kwargs):
+            time.sleep(0.05)
+            return {'Count': 1, 'Items': [
+                {self.hash_key_name: {'S': 'fred'}, self.range_key_name: {'S': 'flintstone'}}]}
+        self.connection.query.side_effect = query
+
+        results = self.table.query(test_hash_key__eq='fred')
+        self.assertEqual(trace.getvalue(), '')
+        self.assertEqual(len(list(results)), 1)
+        entry = json.loads(trace.getvalue())
+        self.assertEqual(entry['op'], 'query')
+        self.assertGreaterEqual(entry['ms'], 50)
+
+
+class LazyDecodeTests(TableTests):
+    def setUp(self):
+        super(LazyDecodeTests, self).setUp()
+
+        class TestItemSubclass(self.duo.Item):
+            table_name = self.table_name
+            cache_duration = 30
+            lazy_decode = True
+            title = self.duo.UnicodeField()
+
+        self.raw = {self.hash_key_name: {'S': 'fred'}, self.range_key_name: {'S': 'flintstone'},
+                    'title': {'S': 'hello'}, 'views': {'N': '12'}, 'tags': {'SS': ['a', 'b']}}
+        self.table = self.db[self.table_name]
+
+    def test_attributes_should_be_decoded_as_they_are_read(self):
+        from decimal import Decimal
+        self.connection.get_item.return_value = {'Item': self.raw}
+        item = self.table.get_item('fred', 'flintstone')
+        self.assertEqual(item.title, u'hello')
+        self.assertEqual(sorted(item._data.raw), ['tags', 'views'])
+        self.assertEqual(item['views'], Decimal(12))
+        self.assertEqual(sorted(item.keys()), sorted(self.raw))
+        self.assertFalse(item.needs_save())
+
+    def test_unread_attributes_should_be_written_and_cached_undecoded(self):
+        self.connection.get_item.return_value = {'Item': self.raw}
+        item = self.table.get_item('fred', 'flintstone')
+        self.assertEqual(item._data.raw['tags'], self.raw['tags'])
+        cached = self.table['fred', 'flintstone']
+        self.assertEqual(cached._data.raw['views'], {'N': '12'})
+        self.assertEqual(cached['tags'], set(['a', 'b']))
+
+        item.title = u'goodbye'
+        self.boto_table._put_item = mock.Mock(return_value=True)
+        item.put()
+        written, expects = self.boto_table._put_item.call_args[0][0], self.boto_table._put_item.call_args[1]['expects']
+        self.assertIs(written['views'], self.raw['views'])
+        self.assertEqual(written['title'], {'S': u'goodbye'})
+        self.assertIs(expects['views']['Value'], self.raw['views'])
+        self.assertEqual(expects['title']['Value'], {'S': 'hello'})
+        self.assertEqual(sorted(item._data.raw), ['tags', 'views'])
+
+    def test_query_results_should_be_lazy_items(self):
+        self.connection.query.return_value = {'Items': [self.raw], 'Count': 1}
+        results = list(self.table.query(test_hash_key__eq='fred'))
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0], self.duo.Item)
+        self.assertEqual(results[0].title, u'hello')
+        self.assertNotIn('title', results[0]._data.raw)
+        self.assertIn('views', results[0]._data.raw)
+
+
+class SharedMemoryCacheTests(unittest.TestCase):
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+
+        import duo
+        self.duo = duo
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'cache')
+
+    def test_values_should_be_shared_between_processes(self):
+        import multiprocessing
+
+        cache = self.duo.SharedMemoryCache(self.path, size=1024 * 1024)
+        cache.set('hello', [('title', u'world')], 30)
+
+        def child():
+            other = self.duo.SharedMemoryCache(self.path, size=1024 * 1024)
+            other.set('answer', other.get('hello') + [('count', 42)])
+        process = multiprocessing.Process(target=child)
+        process.start()
+        process.join()
+
+        self.assertEqual(cache.get('answer'), [('title', u'world'), ('count', 42)])
+        cache.delete('answer')
+        self.assertIsNone(cache.get('answer'))
+        cache.set_multi({'a': 1, 'b': 2}, 30)
+        self.assertEqual(cache.get_multi(['a', 'b', 'c']), {'a': 1, 'b': 2})
+        self.assertTrue(0 < cache.ttl('a') <= 30)
+        self.assertIsNone(cache.ttl('c'))
+        self.assertRaises(ValueError, self.duo.SharedMemoryCache, self.path, size=2 * 1024 * 1024)
+
+    def test_values_should_expire_and_be_evicted(self):
+        import time
+
+        # One group of two slots.
+        cache = self.duo.SharedMemoryCache(self.path, size=3 * 256, slot_size=256, ways=2)
+        self.assertFalse(cache.set('big', 'x' * 1000))
+        cache.set('short', 1, 0.01)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('short'))
+
+        cache.set('soon', 1, 60)
+        cache.set('later', 2, 120)
+        cache.set('forever', 3)
+        self.assertIsNone(cache.get('soon'))
+        self.assertEqual(cache.get_multi(['later', 'forever']), {'later': 2, 'forever': 3})
+        self.assertEqual(cache.incr('later', 5), 7)
+
+
+class TieredCacheTests(unittest.TestCase):
+    def test_lower_tier_hits_should_fill_the_tiers_above(self):
+        import duo
+
+        local, remote = duo.LocalCache(max_items=2), FakeCache()
+        cache = duo.TieredCache([local, remote])
+        remote.set('hello', u'world')
+        self.assertEqual(cache.get('hello'), u'world')
+        self.assertEqual(local.get('hello'), u'world')
+        self.assertEqual(cache.get('hello'), u'world')
+        self.assertEqual(cache.stats[0], 1)
+        self.assertEqual(cache.stats[1], 1)
+
+        cache.set('count', 1)
+        self.assertEqual(cache.incr('count'), 2)
+        self.assertIsNone(local.get('count'))
+        self.assertEqual(cache.get('count'), 2)
+        self.assertFalse(cache.add('count', 5))
+
+    def test_copied_values_should_not_outlive_the_originals(self):
+        import duo
+
+        local, shared, remote = duo.LocalCache(), duo.LocalCache(), FakeCache()
+        cache = duo.TieredCache([local, shared, remote], max_durations=[None, None, None],
+                                promote_duration=5)
+        shared.set('soon', 1, 3)
+        remote.set('unknown', 2)
+        shared.set('forever', 3)
+        self.assertEqual(cache.get_multi(['soon', 'unknown']), {'soon': 1, 'unknown': 2})
+        self.assertEqual(cache.get('forever'), 3)
+
+        self.assertTrue(0 < local.ttl('soon') <= 3)
+        self.assertTrue(0 < local.ttl('unknown') <= 5)
+        self.assertTrue(0 < shared.ttl('unknown') <= 5)
+        self.assertEqual(local.ttl('forever'), 0)
+
+
+class SnapshotTests(TableTests):
+    def setUp(self):
+        super(SnapshotTests, self).setUp()
+        import os
+        import shutil
+        import tempfile
+        from boto.dynamodb2.items import Item
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'snapshot')
+
+        self.items = [Item(self.boto_table, data={
+            self.hash_key_name: hash_key, self.range_key_name: range_key, 'title': u'%s %d' % (hash_key, range_key)})
+            for hash_key in (u'barney', u'fred') for range_key in (1, 2, 10, 20)]
+        self.boto_table.scan = mock.Mock(
+            side_effect=lambda segment, total_segments: iter(self.items[segment::total_segments]))
+        self.assertEqual(self.db[self.table_name].snapshot(self.path, concurrency=2), 8)
+
+        class TestSnapshotTable(self.duo.SnapshotTable):
+            table_name = self.table_name
+            hash_key_name = self.hash_key_name
+            range_key_name = self.range_key_name
+            snapshot_path = self.path
+            snapshot_check_interval = 0
+
+        self.table = self.db[self.table_name]
+
+    def test_reads_should_be_served_from_the_snapshot(self):
+        from decimal import Decimal
+
+        item = self.table['fred', 10]
+        self.assertEqual(item['title'], u'fred 10')
+        self.assertFalse(item.is_new)
+        self.assertTrue(self.table['fred', 3].is_new)
+        self.assertRaises(self.duo.ItemNotFound, self.table.get_item, 'wilma', 1)
+
+        self.assertEqual([i[self.range_key_name] for i in self.table['barney']], [1, 2, 10, 20])
+        results = self.table.query(test_hash_key__eq='fred', test_range_key__between=(2, 15), reverse=True)
+        self.assertEqual([i[self.range_key_name] for i in results], [Decimal(10), Decimal(2)])
+        results = self.table.query(test_hash_key__eq='fred', test_range_key__gt=2, limit=1)
+        self.assertEqual([i['title'] for i in results], [u'fred 10'])
+        self.assertFalse(self.connection.get_item.called)
+        self.assertFalse(self.connection.query.called)
+
+    def test_snapshot_table_itself_should_not_be_registered(self):
+        self.assertNotIn(None, self.duo.Table._table_types)
+        self.assertIs(self.duo.Table._table_types[self.table_name], type(self.table))
+
+    def test_a_new_snapshot_should_replace_the_old_one(self):
+        self.table.get_snapshot()
+        del self.items[1:]
+        self.db[self.table_name].snapshot(self.path, concurrency=1)
+        self.assertTrue(self.table['barney', 2].is_new)
+        self.assertFalse(self.table['barney', 1].is_new)
+
+
+class PartitionCacheTests(TableTests):
+    def setUp(self):
+        super(PartitionCacheTests, self).setUp()
+
+        class TestItemSubclass(self.duo.Item):
+            table_name = self.table_name
+            cache_duration = 30
+
+        class TestTableSubclass(self.duo.Table):
+            table_name = self.table_name
+            hash_key_name = self.hash_key_name
+            range_key_name = self.range_key_name
+            partition_cache = True
+
+        self.table = self.db[self.table_name]
+        self.connection.query.return_value = {'Count': 4, 'Items': [
+            {self.hash_key_name: {'S': 'fred'}, self.range_key_name: {'N': str(range_key)},
+             'title': {'S': 'fred %d' % range_key}} for range_key in (1, 2, 10, 20)]}
+
+    def test_queries_should_be_answered_from_the_cached_partition(self):
+        from decimal import Decimal
+
+        self.assertEqual([i[self.range_key_name] for i in self.table['fred']], [1, 2, 10, 20])
+        self.assertEqual(self.connection.query.call_count, 1)
+
+        results = self.table.query(test_hash_key__eq='fred', test_range_key__between=(2, 15), reverse=True)
+        self.assertEqual([i[self.range_key_name] for i in results], [Decimal(10), Decimal(2)])
+        results = self.table.query(test_hash_key__eq='fred', test_range_key__gt=2, limit=1)
+        self.assertEqual([i['title'] for i in results], [u'fred 10'])
+        self.assertFalse(results[0].is_new)
+        results = self.table.query(test_hash_key__eq='fred', test_range_key__lt=1)
+        self.assertEqual(results, [])
+        self.assertEqual(self.connection.query.call_count, 1)
+        self.assertEqual(self.db.stats['partition_cache_hits'], 3)
+
+        list(self.table.query(test_hash_key__eq='fred', consistent=True))
+        self.assertEqual(self.connection.query.call_count, 2)
+
+    def test_writes_should_drop_the_cached_partition(self):
+        self.table['fred']
+        self.boto_table._put_item = mock.Mock(return_value=True)
+        self.table.create('fred', 5).put()
+        self.table['fred']
+        self.assertEqual(self.connection.query.call_count, 2)
+
+        self.table['barney']
+        self.boto_table.delete_item = mock.Mock(return_value=True)
+        self.table.create('fred', 5).delete()
+        self.table['barney']
+        self.table['fred']
+        self.assertEqual(self.connection.query.call_count, 4)
+
+    def test_big_partitions_should_not_be_cached(self):
+        self.table.partition_cache_max_items = 3
+        self.assertEqual(len(list(self.table['fred'])), 4)
+        self.assertEqual(len(list(self.table['fred'])), 4)
+        self.assertEqual(self.connection.query.call_count, 3)
+
+
+class MapReduceTests(TableTests):
+    def setUp(self):
+        super(MapReduceTests, self).setUp()
+
+        class TestItemSubclass(self.duo.Item):
+            table_name = self.table_name
+
+            score = self.duo.IntField()
+
+        self.item_class = TestItemSubclass
+        self.table = self.db[self.table_name]
+
+        def scan(table_name, segment=None, total_segments=None, **kwargs):
+            return {'Count': 10, 'Items': [
+                {self.hash_key_name: {'S': 'player%d' % i}, self.range_key_name: {'S': 'game'},
+                 'score': {'N': str(i)}} for i in range(segment * 10, segment * 10 + 10)]}
+        self.connection.scan.side_effect = scan
+
+    def test_map_reduce_should_combine_the_segments_of_every_worker(self):
+        import operator
+
+        item_class = self.item_class
+        self.assertEqual(self.table.map_reduce(
+            lambda item: item.score if isinstance(item, item_class) else None,
+            operator.add, segments=4, processes=2), sum(range(40)))
+        self.assertEqual(self.table.map_reduce(
+            lambda item: 1, operator.add, segments=3, processes=2, score__gt=100), 30)
+
+    def test_workers_should_start_their_own_thread_pools(self):
+        import operator
+
+        get_thread_pool = self.duo._get_thread_pool
+        self.assertEqual(get_thread_pool(3).map(abs, [-1]), [1])
+        self.assertEqual(self.table.map_reduce(
+            lambda item: get_thread_pool(3).map(abs, [item.score])[0],
+            operator.add, segments=2, processes=2), sum(range(20)))
+
+    def test_map_reduce_of_nothing_should_return_the_default(self):
+        self.connection.scan.side_effect = None
+        self.connection.scan.return_value = {'Count': 0, 'Items': []}
+        self.assertEqual(self.table.map_reduce(lambda item: 1, max, segments=2, processes=2, default=0), 0)
+
+
+class StartupTests(unittest.TestCase):
+    def test_importing_duo_should_cost_less_than_importing_boto(self):
+        import bench_startup
+
+        results = [bench_startup.run(classes=10) for _ in range(3)]
+        self.assertFalse(any(boto_imported for _, _, boto_imported in results))
+        self.assertLess(bench_startup.median([import_time for import_time, _, _ in results]),
+                        bench_startup.median([bench_startup.run_boto() for _ in range(3)]))
+
+    def test_item_should_be_built_on_boto_item_when_subclassed(self):
+        # In a fresh interpreter, so boto isn't already loaded.
+        script = """
+import sys
+import duo
+assert 'boto' not in sys.modules
+class Item(duo.Item):
+    table_name = 'startup'
+from boto.dynamodb2.items import Item as BotoItem
+from boto.dynamodb2.exceptions import ItemNotFound
+assert Item.__mro__.index(duo.Item) < Item.__mro__.index(BotoItem)
+assert duo.Item._table_types['startup'] is Item
+assert isinstance(object.__new__(Item), duo.Item)
+assert issubclass(ItemNotFound, duo.ItemNotFound)
+assert isinstance(ItemNotFound('missing'), duo.ItemNotFound)
+assert not issubclass(KeyError, duo.ItemNotFound)
+"""
+        subprocess.check_call([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)))